@@ -0,0 +1,508 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks
+    ~~~~~~~~~~
+
+    Flask Exceptional extension benchmarks. Run all benchmarks with::
+
+        $ python benchmarks.py
+
+    or name the benchmarks to run::
+
+        $ python benchmarks.py startup
+
+    Pass ``--json`` to emit the results as JSON, e.g. to compare them across
+    revisions::
+
+        $ python benchmarks.py --json pipeline > results.json
+
+    :copyright: (c) 2012 by Jonathan Zempel.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from contextlib import contextmanager
+from datetime import datetime
+from re import match
+from subprocess import check_output
+from threading import Thread
+from time import time
+from timeit import timeit
+from zlib import decompress
+import json
+import os
+import sys
+
+IMPORT_SCRIPT = """
+from time import time
+import flask
+start = time()
+%s
+import flask_exceptional
+print time() - start
+"""
+
+
+def median(values):
+    """Get the median of the given values.
+    """
+    values = sorted(values)
+
+    return values[len(values) // 2]
+
+
+def percentile(values, percent):
+    """Get the given percentile of the given values.
+    """
+    values = sorted(values)
+
+    return values[min(int(len(values) * percent / 100.0), len(values) - 1)]
+
+
+@contextmanager
+def scenario_baseline(app):
+    """A plain error. Yields the request path and headers.
+    """
+    yield "/error", {}
+
+
+@contextmanager
+def scenario_large_env(app, variables=1000):
+    """An error in a process with a large OS environment.
+    """
+    names = ["BENCHMARK_VARIABLE_%d" % index for index in xrange(variables)]
+
+    for name in names:
+        os.environ[name] = "x" * 100
+
+    try:
+        yield "/error", {}
+    finally:
+        for name in names:
+            del os.environ[name]
+
+
+@contextmanager
+def scenario_many_packages(app, packages=500):
+    """An error in a process with many installed distributions.
+    """
+    import pkg_resources
+
+    working_set = pkg_resources.working_set
+    pkg_resources.working_set = pkg_resources.WorkingSet([])
+
+    for distribution in working_set:
+        pkg_resources.working_set.add(distribution)
+
+    for index in xrange(packages):
+        pkg_resources.working_set.add(pkg_resources.Distribution(
+            location="/benchmark/%d" % index,
+            project_name="benchmark-package-%d" % index, version="1.0"))
+
+    try:
+        yield "/error", {}
+    finally:
+        pkg_resources.working_set = working_set
+
+
+@contextmanager
+def scenario_deep_stack(app, depth=500):
+    """An error raised at the bottom of a deep recursion.
+    """
+    def recurse(depth):
+        if depth:
+            recurse(depth - 1)
+        else:
+            1 / 0
+
+    app.add_url_rule("/deep", "deep", lambda: recurse(depth))
+
+    yield "/deep", {}
+
+
+@contextmanager
+def scenario_large_cookies(app, cookies=20):
+    """An error in a request with large cookies.
+    """
+    cookie = "; ".join("cookie%d=%s" % (index, "x" * 200)
+        for index in xrange(cookies))
+
+    yield "/error", {"Cookie": cookie}
+
+
+@contextmanager
+def scenario_many_filters(app, patterns=300):
+    """An error with many filter patterns for every filter setting.
+    """
+    from flask_exceptional import FILTERS
+
+    for name in FILTERS:
+        app.config[name] = ["BENCHMARK_%d_.*" % index
+            for index in xrange(patterns)]
+
+    yield "/error", {}
+
+
+SCENARIOS = {
+    "baseline": scenario_baseline,
+    "deep_stack": scenario_deep_stack,
+    "large_cookies": scenario_large_cookies,
+    "large_env": scenario_large_env,
+    "many_filters": scenario_many_filters,
+    "many_packages": scenario_many_packages
+}
+
+
+def benchmark_pipeline(errors=200, threads=8):
+    """Benchmark the full error reporting pipeline against a local stand-in
+    for the Exceptional API, for each scenario in :data:`SCENARIOS`. Reports
+    the end-to-end request latency, the throughput of concurrent errors, the
+    encoded and compressed bytes per error, and the mean latency of each
+    pipeline stage.
+    """
+    from flask import Flask
+    from flask_exceptional import ConnectionPool, Exceptional
+    from tests import StandInServer
+
+    server = StandInServer()
+    ret_val = {}
+
+    try:
+        for name, scenario in sorted(SCENARIOS.items()):
+            app = Flask(__name__)
+            app.config["EXCEPTIONAL_API_KEY"] = "key"
+            app.config["EXCEPTIONAL_METRICS"] = True
+            app.config["PROPAGATE_EXCEPTIONS"] = False
+
+            @app.route("/error")
+            def error():
+                1 / 0
+
+            with scenario(app) as (path, headers):
+                exceptional = Exceptional(app)
+                exceptional.url = server.url
+                exceptional.pool = ConnectionPool.get(server.url)
+                client = app.test_client()
+                latencies = []
+
+                for index in xrange(errors):
+                    start = time()
+                    client.get(path, headers=headers)
+                    latencies.append(time() - start)
+
+                def run():
+                    client = app.test_client()
+
+                    for index in xrange(errors // threads):
+                        client.get(path, headers=headers)
+
+                workers = [Thread(target=run) for index in xrange(threads)]
+                start = time()
+
+                for worker in workers:
+                    worker.start()
+
+                for worker in workers:
+                    worker.join()
+
+                throughput = errors // threads * threads / (time() - start)
+
+            body = server.posts[-1]
+            del server.posts[:]
+            ret_val["%s.latency_p50" % name] = median(latencies) * 1000
+            ret_val["%s.latency_p95" % name] = percentile(latencies, 95) * 1000
+            ret_val["%s.throughput" % name] = (throughput, "errors/s")
+            ret_val["%s.bytes" % name] = (len(decompress(body)), "bytes")
+            ret_val["%s.compressed_bytes" % name] = (len(body), "bytes")
+
+            for stage, histogram in exceptional.metrics.histograms.items():
+                if stage != "request":
+                    ret_val["%s.%s" % (name, stage)] = histogram.mean * 1000
+    finally:
+        server.stop()
+
+    return ret_val
+
+
+def benchmark_startup(runs=15):
+    """Benchmark the cost of importing ``flask_exceptional`` in a fresh
+    interpreter. The ``eager`` case imports ``pkg_resources`` alongside the
+    extension, which is what importing the extension cost before the
+    ``pkg_resources`` import was deferred.
+    """
+    cases = (
+        ("lazy", ""),
+        ("eager", "import pkg_resources")
+    )
+    ret_val = {}
+
+    for name, setup in cases:
+        script = IMPORT_SCRIPT % setup
+        timings = []
+
+        for index in xrange(runs):
+            output = check_output([sys.executable, "-c", script])
+            timings.append(float(output))
+
+        ret_val[name] = median(timings) * 1000
+
+    return ret_val
+
+
+def benchmark_filter(patterns=300, keys=500, runs=3):
+    """Benchmark filtering a large dictionary against many filter patterns.
+    The ``naive`` case matches every key against every pattern, as filters
+    did before they were compiled.
+    """
+    from flask_exceptional import Filter
+
+    filter = ["FILTER_%d_.*" % index for index in xrange(patterns)]
+    data = dict(("HTTP_X_HEADER_%d" % index, "value")
+        for index in xrange(keys))
+
+    def naive():
+        ret_val = {}
+
+        for key, value in data.iteritems():
+            for item in filter:
+                if match(item, key):
+                    value = "[FILTERED]"
+                    break
+
+            ret_val[key] = value
+
+        return ret_val
+
+    def cold():
+        Filter(filter).apply(data)
+
+    compiled = Filter(filter)
+
+    def warm():
+        compiled.apply(data)
+
+    return {
+        "naive": timeit(naive, number=runs) / runs * 1000,
+        "cold": timeit(cold, number=runs) / runs * 1000,
+        "warm": timeit(warm, number=runs) / runs * 1000
+    }
+
+
+def benchmark_backtrace(depth=900, runs=20):
+    """Benchmark building exception data for a deep recursion error. The
+    ``naive`` case builds the backtrace by repeatedly inserting at the front
+    of a list, as exception data was built before.
+    """
+    from flask_exceptional import Backtrace, Exceptional
+
+    def recurse(depth):
+        if depth:
+            recurse(depth - 1)
+        else:
+            raise RuntimeError("maximum recursion depth exceeded")
+
+    try:
+        recurse(depth)
+    except RuntimeError:
+        backtrace = Backtrace.capture()
+
+    get_exception_data = Exceptional._Exceptional__get_exception_data
+
+    def naive():
+        ret_val = []
+
+        for frame in backtrace.frames:
+            ret_val.insert(0, "File \"%s\", line %d, in %s\n\t%s" % (
+                frame.filename,
+                frame.lineno,
+                frame.function_name,
+                frame.current_line.strip()
+            ))
+
+        return ret_val
+
+    timestamp = datetime.utcnow()
+
+    def linear():
+        get_exception_data(backtrace, timestamp)
+
+    def truncated():
+        get_exception_data(backtrace, timestamp, max_frames=200)
+
+    return {
+        "naive": timeit(naive, number=runs) / runs * 1000,
+        "linear": timeit(linear, number=runs) / runs * 1000,
+        "truncated": timeit(truncated, number=runs) / runs * 1000
+    }
+
+
+def benchmark_report(runs=200):
+    """Benchmark the latency an error adds to the request thread. The
+    ``eager`` case encodes the error data on the request thread, as errors
+    were reported before; the ``lazy`` case only captures a :class:`Report`
+    snapshot, deferring encoding to the background delivery thread.
+    """
+    from flask import _request_ctx_stack as stack, Flask
+    from flask_exceptional import Exceptional, Worker
+
+    app = Flask(__name__)
+    app.config["EXCEPTIONAL_API_KEY"] = "key"
+    app.config["EXCEPTIONAL_HEADER_FILTER"] = ["Authorization", "X-Secret"]
+    exceptional = Exceptional(app)
+    exceptional.url = "http://127.0.0.1/api/errors"
+    exceptional.worker = Worker(None, size=runs * 2)  # never started.
+    headers = dict(("X-Header-%d" % index, "value %d" % index)
+        for index in xrange(50))
+    headers["Cookie"] = "; ".join("cookie%d=%s" % (index, "x" * 64)
+        for index in xrange(20))
+    data = dict(("field%d" % index, "value %d" % index)
+        for index in xrange(50))
+    ret_val = {}
+
+    with app.test_request_context("/error", method="POST", headers=headers,
+            data=data):
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            def lazy():
+                exceptional._post_data(stack.top)
+
+            def eager():
+                exceptional._post_data(stack.top).data
+
+            for name, function in (("lazy", lazy), ("eager", eager)):
+                exceptional._get_application_json(app)  # warm the cache.
+                ret_val[name] = timeit(function, number=runs) / runs * 1000
+
+    return ret_val
+
+
+def error_data():
+    """Get realistic error data, including the full application environment.
+    Returns the application, extension and JSON encoded error data.
+    """
+    from flask import _request_ctx_stack as stack, Flask
+    from flask_exceptional import Exceptional, Worker
+
+    app = Flask(__name__)
+    app.config["EXCEPTIONAL_API_KEY"] = "key"
+    exceptional = Exceptional(app)
+    exceptional.url = "http://127.0.0.1/api/errors"
+    exceptional.worker = Worker(None)  # never started.
+    headers = {"Cookie": "session=%s" % ("x" * 256)}
+
+    with app.test_request_context("/error?page=1", headers=headers):
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            data = exceptional._post_data(stack.top).data
+
+    return app, exceptional, data
+
+
+def benchmark_compression(runs=50):
+    """Benchmark compressing realistic error data, including the full
+    application environment, with each compression setting. Reports the CPU
+    time per error and the bytes on the wire.
+    """
+    app, exceptional, data = error_data()
+    cases = [(None, 0)] + [(encoding, level) for encoding in
+        ("deflate", "gzip") for level in (1, 6, 9)]
+    ret_val = {}
+
+    for encoding, level in cases:
+        app.config["EXCEPTIONAL_COMPRESSION"] = encoding
+        app.config["EXCEPTIONAL_COMPRESSION_LEVEL"] = level
+        name = "%s-%d" % (encoding, level) if encoding else "none"
+
+        def function():
+            return exceptional._compress(app, data)
+
+        ret_val[name] = timeit(function, number=runs) / runs * 1000
+        ret_val["%s.bytes" % name] = (len(function()[0]), "bytes")
+
+    return ret_val
+
+
+def benchmark_metrics(runs=500):
+    """Benchmark the request-thread latency of capturing an error with
+    metrics ``disabled`` and ``enabled``.
+    """
+    from flask import _request_ctx_stack as stack, Flask
+    from flask_exceptional import Exceptional, Metrics, Worker
+
+    app = Flask(__name__)
+    app.config["EXCEPTIONAL_API_KEY"] = "key"
+    exceptional = Exceptional(app)
+    exceptional.url = "http://127.0.0.1/api/errors"
+    ret_val = {}
+
+    with app.test_request_context("/error"):
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            def function():
+                exceptional._post_data(stack.top)
+
+            for name, metrics in (("disabled", None), ("enabled", Metrics())):
+                exceptional.metrics = metrics
+                exceptional.worker = Worker(None, size=runs)  # never started.
+                ret_val[name] = timeit(function, number=runs) / runs * 1000
+
+    return ret_val
+
+
+def benchmark_reference():
+    """Measure the bytes per error on the wire with the full application
+    environment block, and with a reference to an acknowledged block, both
+    uncompressed and compressed.
+    """
+    from flask_exceptional import ENVIRONMENT_PREFIX
+
+    app, exceptional, data = error_data()
+    application_data = exceptional._get_application_json(app)
+    start = len(ENVIRONMENT_PREFIX) + len(application_data) + 2
+    reference = '%s{"reference": "%s"}, %s' % (ENVIRONMENT_PREFIX,
+            "0" * 40, data[start:])
+    ret_val = {}
+
+    for name, value in (("full", data), ("reference", reference)):
+        ret_val["%s.none" % name] = (len(value), "bytes")
+        ret_val["%s.deflate-1" % name] = (len(exceptional._compress(app,
+            value)[0]), "bytes")
+
+    return ret_val
+
+
+BENCHMARKS = {
+    "backtrace": benchmark_backtrace,
+    "compression": benchmark_compression,
+    "filter": benchmark_filter,
+    "metrics": benchmark_metrics,
+    "pipeline": benchmark_pipeline,
+    "reference": benchmark_reference,
+    "report": benchmark_report,
+    "startup": benchmark_startup
+}
+
+if __name__ == "__main__":
+    arguments = sys.argv[1:]
+    emit_json = "--json" in arguments
+    names = [name for name in arguments if name != "--json"] or \
+        sorted(BENCHMARKS)
+    results = {}
+
+    for name in names:
+        results[name] = BENCHMARKS[name]()
+
+        if not emit_json:
+            for case, value in sorted(results[name].items()):
+                if isinstance(value, tuple):
+                    print "%s.%s: %d %s" % ((name, case) + value)
+                else:
+                    print "%s.%s: %.2f ms" % (name, case, value)
+
+    if emit_json:
+        print json.dumps(dict((name, dict((case, value[0]
+            if isinstance(value, tuple) else value) for case, value in
+            cases.items())) for name, cases in results.items()), indent=2,
+            sort_keys=True)
@@ -10,17 +10,35 @@
 """
 
 from __future__ import with_statement
+from bisect import bisect_left
+from collections import deque
 from Cookie import SimpleCookie
 from datetime import datetime
+from email.utils import mktime_tz, parsedate_tz
 from flask import _request_ctx_stack as stack, Config, Flask, g
 from functools import wraps
-from httplib import BadStatusLine
-from re import match
-from urllib2 import HTTPError, Request, urlopen, URLError
-from werkzeug import Headers
-from werkzeug.debug import tbtools
-from zlib import compress
+from hashlib import sha1
+from heapq import heappop, heappush
+from httplib import BadStatusLine, HTTPConnection, HTTPException, \
+    HTTPSConnection
+from Queue import Empty, Full, Queue
+from random import random
+from re import compile as compile_regex, error as RegexError
+from struct import pack, unpack_from
+from threading import Condition, Event, Lock, Thread
+from time import sleep, time
+from traceback import format_exception_only
+from urllib import getproxies, proxy_bypass, unquote
+from urllib2 import HTTPError
+from urlparse import urlsplit
+from werkzeug import BaseRequest, Headers
+from zlib import compress, compressobj, DEFLATED, error as ZlibError, \
+    MAX_WBITS
+import atexit
+import errno
+import linecache
 import os
+import socket
 import sys
 
 try:
@@ -29,11 +47,1914 @@ except ImportError:
     from flask import json
 
 try:
-    import pkg_resources
+    import fcntl
 except ImportError:
-    pkg_resources = None  # NOQA
+    fcntl = None  # NOQA
 
 EXCEPTIONAL_URL = "http://api.exceptional.io/api/errors"
+ENCODINGS = (None, "deflate", "gzip")  # error data content encodings.
+ENVIRONMENT_PREFIX = '{"application_environment": '
+REFERENCE_HEADER = "X-Exceptional-Environment-Reference"
+FILTERS = (
+    "EXCEPTIONAL_COOKIE_FILTER",
+    "EXCEPTIONAL_ENVIRONMENT_FILTER",
+    "EXCEPTIONAL_HEADER_FILTER",
+    "EXCEPTIONAL_PARAMETER_FILTER",
+    "EXCEPTIONAL_SESSION_FILTER"
+)
+
+_FLUSH = object()
+_GROUP_REFERENCE = compile_regex(
+    r"(?:^|[^\\])(?:\\\\)*(?:\\[1-9]|\(\?P=|\(\?\()")
+_filters = {}
+_filters_lock = Lock()
+_lines = {}
+_pkg_resources = None
+_version = None
+_pools = {}
+_pools_lock = Lock()
+_publishers = {}
+_publishers_lock = Lock()
+
+
+def _freeze(value):
+    """Get a hashable, stable key for the given configuration value.
+    Containers are frozen recursively and compiled regular expressions are
+    keyed by their pattern and flags, not their identity.
+    """
+    if isinstance(value, dict):
+        ret_val = tuple(sorted((key, _freeze(item))
+            for key, item in value.iteritems()))
+    elif isinstance(value, (set, frozenset)):
+        ret_val = tuple(sorted(_freeze(item) for item in value))
+    elif isinstance(value, (list, tuple)):
+        ret_val = tuple(_freeze(item) for item in value)
+    elif hasattr(value, "pattern") and hasattr(value, "flags"):
+        ret_val = (value.pattern, value.flags)
+    else:
+        try:
+            hash(value)
+            ret_val = value
+        except TypeError:
+            ret_val = repr(value)
+
+    return ret_val
+
+
+def _get_pkg_resources():
+    """Get the ``pkg_resources`` module, importing it on first use. Importing
+    ``pkg_resources`` scans every installed distribution, so it is deferred
+    until error data is first reported. Returns ``None`` if setuptools is not
+    installed.
+    """
+    global _pkg_resources
+
+    if _pkg_resources is None:
+        try:
+            import pkg_resources as _pkg_resources
+        except ImportError:
+            _pkg_resources = False
+
+    return _pkg_resources or None
+
+
+class PayloadEncoder(json.JSONEncoder):
+    """JSON encoder for Exceptional error data. Data is encoded as ASCII JSON
+    so clean data takes the C accelerated encoding path. Data containing byte
+    strings that are not valid UTF-8 is encoded in a second pass, with the
+    invalid bytes decoded as replacement characters. Unlike patching
+    ``json.encoder``, this never touches global state.
+    """
+
+    def encode(self, o):
+        """Get the UTF-8 encoded JSON representation of the given object.
+
+        :param o: The object to encode.
+        """
+        try:
+            ret_val = json.JSONEncoder.encode(self, o)
+        except UnicodeDecodeError:
+            ret_val = json.JSONEncoder.encode(self, self.sanitize(o))
+
+        if isinstance(ret_val, unicode):
+            ret_val = ret_val.encode("utf-8")
+
+        return ret_val
+
+    @staticmethod
+    def sanitize(o):
+        """Get a copy of the given object with every byte string decoded as
+        UTF-8, replacing invalid bytes.
+
+        :param o: The object to sanitize.
+        """
+        if isinstance(o, str):
+            ret_val = o.decode("utf-8", "replace")
+        elif isinstance(o, dict):
+            ret_val = {}
+
+            for key, value in o.iteritems():
+                ret_val[PayloadEncoder.sanitize(key)] = \
+                    PayloadEncoder.sanitize(value)
+        elif isinstance(o, (list, tuple)):
+            ret_val = [PayloadEncoder.sanitize(value) for value in o]
+        else:
+            ret_val = o
+
+        return ret_val
+
+
+_encoder = PayloadEncoder()
+
+
+class Frame(object):
+    """A single frame of a :class:`Backtrace`.
+
+    :param filename: The source file name.
+    :param lineno: The source line number.
+    :param function_name: The function name.
+    :param module_globals: Default ``None``. The frame globals, used to load
+                           source lines via a module's ``__loader__``.
+    """
+
+    __slots__ = ("filename", "lineno", "function_name", "module_globals")
+
+    def __init__(self, filename, lineno, function_name, module_globals=None):
+        """Create this frame.
+        """
+        self.filename = filename
+        self.lineno = lineno
+        self.function_name = function_name
+        self.module_globals = module_globals
+
+    @property
+    def current_line(self):
+        """Get the source line for this frame. Source lines are cached per
+        file name and line number, so source files are read at most once.
+        """
+        key = (self.filename, self.lineno)
+        ret_val = _lines.get(key)
+
+        if ret_val is None:
+            ret_val = linecache.getline(self.filename, self.lineno,
+                    self.module_globals).strip()
+
+            if len(_lines) < 10000:
+                _lines[key] = ret_val
+
+        return ret_val
+
+
+class Backtrace(object):
+    """Lightweight capture of an exception stack trace. Unlike
+    :func:`werkzeug.debug.tbtools.get_current_traceback`, only the frame data
+    reported to Exceptional is captured. Backtraces provide the same
+    ``exception``, ``exception_type`` and ``frames`` attributes as a
+    :class:`werkzeug.debug.tbtools.Traceback`.
+
+    :param exc_type: The exception type.
+    :param exc_value: The exception instance.
+    :param tb: The traceback object.
+    """
+
+    def __init__(self, exc_type, exc_value, tb):
+        """Create this backtrace.
+        """
+        exception_type = exc_type.__name__
+
+        if exc_type.__module__ not in ("__builtin__", "exceptions"):
+            exception_type = "%s.%s" % (exc_type.__module__, exception_type)
+
+        self.exception_type = exception_type
+        self.exception = "".join(format_exception_only(exc_type,
+                exc_value)).strip()
+        self.frames = []
+
+        while tb is not None:
+            frame = tb.tb_frame
+            self.frames.append(Frame(frame.f_code.co_filename, tb.tb_lineno,
+                frame.f_code.co_name, frame.f_globals))
+            tb = tb.tb_next
+
+    @staticmethod
+    def capture():
+        """Capture the exception currently being handled.
+        """
+        return Backtrace(*sys.exc_info())
+
+
+class Report(object):
+    """Snapshot of an error, captured where the error occurs. Only data that
+    would otherwise be lost is captured: the stack trace, the request
+    environment variables and parameters, and shallow copies of the session
+    and context data. Filtering and encoding are deferred until the encoded
+    :attr:`data` is first accessed, for example by the background delivery
+    thread.
+
+    :param exceptional: The :class:`Exceptional` extension that encodes this
+                        report.
+    :param app: The application the error occurred in.
+    :param traceback: The exception stack trace.
+    :param environ: Default ``None``. The request environment variables.
+    :param endpoint: Default ``None``. The request endpoint.
+    :param controller: Default ``None``. The request blueprint or module.
+    :param parameters: Default ``None``. The request parameters.
+    :param session: Default ``None``. The session data.
+    :param context: Default ``None``. The extra context data.
+    :param occurrences: Default 1. The number of occurrences this report
+                        represents.
+    :param sample_weight: Default 1. The number of sampled errors this report
+                          represents.
+    :param fingerprint: Default ``None``. The error fingerprint.
+    :param data: Default ``None``. Already encoded error data, e.g. received
+                 by an :class:`Agent`.
+    """
+
+    def __init__(self, exceptional, app, traceback, environ=None,
+            endpoint=None, controller=None, parameters=None, session=None,
+            context=None, occurrences=1, sample_weight=1, fingerprint=None,
+            data=None):
+        """Create this report.
+        """
+        self.exceptional = exceptional
+        self.app = app
+        self.traceback = traceback
+        self.timestamp = datetime.utcnow()
+        self.environ = environ
+        self.endpoint = endpoint
+        self.controller = controller
+        self.parameters = parameters
+        self.session = session
+        self.context = context
+        self.occurrences = occurrences
+        self.sample_weight = sample_weight
+        self.fingerprint = fingerprint
+        self._data = data
+
+    @property
+    def data(self):
+        """Get the JSON encoded error data, encoding it on first access.
+        """
+        if self._data is None:
+            self._data = self.exceptional._encode(self)
+
+        return self._data
+
+
+class Filter(object):
+    """Compiled ``EXCEPTIONAL_*_FILTER`` patterns. The patterns are combined
+    into a single alternation regular expression, and match results are
+    cached per key so repeated keys skip matching altogether. Patterns with
+    inline flags or group references, which would leak into or break the
+    alternation, are matched separately.
+
+    :param patterns: The strings or regular expression patterns to filter.
+    :param cache_size: Default 4096. The maximum number of cached keys.
+    """
+
+    def __init__(self, patterns, cache_size=4096):
+        """Create this filter.
+        """
+        self.patterns = tuple(patterns)
+        self.cache_size = cache_size
+        self.cache = {}
+        strings = []
+        self.regexes = []
+
+        for pattern in self.patterns:
+            if isinstance(pattern, basestring):
+                regex = compile_regex(pattern)
+
+                # Inline flags apply to the whole expression and group
+                # numbers shift once combined, so match those separately.
+                if regex.flags or _GROUP_REFERENCE.search(pattern):
+                    self.regexes.append(regex)
+                else:
+                    strings.append(pattern)
+            else:
+                # Compiled patterns keep their own flags.
+                self.regexes.append(pattern)
+
+        if len(strings) > 1:
+            try:
+                self.regexes.insert(0, compile_regex("|".join("(?:%s)" %
+                    pattern for pattern in strings)))
+            except (AssertionError, OverflowError, RegexError):
+                # Too many groups to combine; match each pattern separately.
+                self.regexes[:0] = [compile_regex(pattern)
+                    for pattern in strings]
+        elif strings:
+            self.regexes.insert(0, compile_regex(strings[0]))
+
+    @staticmethod
+    def get(patterns):
+        """Get the shared compiled filter for the given patterns.
+
+        :param patterns: The strings or regular expression patterns to filter.
+        """
+        key = tuple(patterns)
+
+        with _filters_lock:
+            ret_val = _filters.get(key)
+
+            if ret_val is None:
+                ret_val = _filters[key] = Filter(key)
+
+        return ret_val
+
+    def apply(self, data):
+        """Get a copy of the given dictionary with the values of filtered
+        keys replaced by ``'[FILTERED]'``.
+
+        :param data: The dictionary of data to filter.
+        """
+        ret_val = {}
+
+        for key, value in data.iteritems():
+            if self.match(key):
+                value = "[FILTERED]"
+
+            ret_val[key] = value
+
+        return ret_val
+
+    def match(self, key):
+        """Determine whether the given key is filtered.
+
+        :param key: The key to match.
+        """
+        ret_val = self.cache.get(key)
+
+        if ret_val is None:
+            ret_val = False
+
+            for regex in self.regexes:
+                if regex.match(key):
+                    ret_val = True
+                    break
+
+            if len(self.cache) < self.cache_size:
+                self.cache[key] = ret_val
+
+        return ret_val
+
+
+class ConnectionPool(object):
+    """Pool of keep-alive HTTP connections to a single host. Connections are
+    reused across error submissions to avoid a TCP (and TLS) handshake for
+    every error. Like :func:`urllib2.urlopen`, the pool connects through the
+    ``http_proxy`` or ``https_proxy`` environment proxy, unless the host is
+    excluded by ``no_proxy``.
+
+    :param url: The URL to POST error data to.
+    :param size: Default 4. The maximum number of idle connections kept.
+    :param idle_timeout: Default 60. The number of seconds an idle connection
+                         may be kept before it is discarded.
+    :param connect_timeout: Default 5. The socket connect timeout in seconds.
+    :param read_timeout: Default 10. The socket read timeout in seconds.
+    :param total_timeout: Default ``None``. The maximum number of seconds for
+                          a POST, including connecting. Every socket operation
+                          is bounded by the time remaining.
+    """
+
+    def __init__(self, url, size=4, idle_timeout=60, connect_timeout=5,
+            read_timeout=10, total_timeout=None):
+        """Create this connection pool.
+        """
+        parts = urlsplit(url)
+
+        if parts.scheme == "https":
+            self.connection_class = HTTPSConnection
+        else:
+            self.connection_class = HTTPConnection
+
+        self.host = parts.hostname
+        self.port = parts.port
+        self.netloc = parts.netloc
+        self.proxy = getproxies().get(parts.scheme)
+        self.proxy_headers = {}
+
+        if self.proxy and not proxy_bypass(parts.hostname):
+            if "://" not in self.proxy:
+                self.proxy = "http://%s" % self.proxy
+
+            self.proxy = urlsplit(self.proxy)
+
+            if self.proxy.username:
+                credentials = "%s:%s" % (unquote(self.proxy.username),
+                        unquote(self.proxy.password or ""))
+                self.proxy_headers["Proxy-Authorization"] = "Basic %s" % \
+                        credentials.encode("base64").replace("\n", "")
+        else:
+            self.proxy = None
+
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.total_timeout = total_timeout
+        self.connections = []
+        self.lock = Lock()
+        self.pid = os.getpid()
+
+    @staticmethod
+    def get(url, **kwargs):
+        """Get the shared connection pool for the host of the given URL.
+
+        :param url: The URL to get a connection pool for.
+        :param kwargs: Keyword arguments for creating the pool.
+        """
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc) + tuple(sorted(kwargs.items()))
+
+        with _pools_lock:
+            ret_val = _pools.get(key)
+
+            if ret_val is None:
+                ret_val = _pools[key] = ConnectionPool(url, **kwargs)
+
+        return ret_val
+
+    def close(self):
+        """Close all idle connections in this pool.
+        """
+        with self.lock:
+            connections, self.connections = self.connections, []
+
+        for connection, used in connections:
+            connection.close()
+
+    def post(self, url, body, headers):
+        """POST the given body to a URL on this pool's host. Returns the
+        response status, reason and headers as a tuple.
+
+        :param url: The URL to POST to.
+        :param body: The request body.
+        :param headers: A dictionary of request headers.
+        """
+        path, headers = self._prepare(url, headers)
+        deadline = self._deadline()
+        connection, reused = self._acquire(deadline)
+
+        try:
+            response = self._request(connection, path, body, headers,
+                    self._timeout(self.read_timeout, deadline))
+        except (socket.error, BadStatusLine):
+            connection.close()
+
+            if not reused:
+                raise
+
+            # The idle connection went stale; retry on a fresh connection.
+            connection, reused = self._create(deadline), False
+
+            try:
+                response = self._request(connection, path, body, headers,
+                        self._timeout(self.read_timeout, deadline))
+            except:
+                connection.close()
+                raise
+        except:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(connection)
+
+        return response.status, response.reason, response.msg
+
+    def pipeline(self, url, requests):
+        """POST the given bodies to a URL on this pool's host over a single
+        connection, writing every request before reading the responses
+        (HTTP/1.1 pipelining). Requests the server closed the connection
+        before reading are resent on a new connection. Returns a list
+        holding, for each request, the response status, reason and headers
+        as a tuple, or the exception raised for a request that was not
+        answered; this method never raises.
+
+        :param url: The URL to POST to.
+        :param requests: A list of ``(body, headers)`` tuples.
+        """
+        data = []
+
+        for body, headers in requests:
+            path, headers = self._prepare(url, headers)
+            data.append(self._format(path, headers, body))
+
+        data = "".join(data)
+        deadline = self._deadline()
+        ret_val = []
+
+        try:
+            connection, reused = self._acquire(deadline)
+        except Exception, e:
+            return [e] * len(requests)
+
+        try:
+            connection.sock.settimeout(self._timeout(self.read_timeout,
+                    deadline))
+            connection.sock.sendall(data)
+
+            while len(ret_val) < len(requests):
+                response = connection.response_class(connection.sock,
+                        method="POST")
+                response.begin()
+                response.read()  # drain the response to reach the next.
+                ret_val.append((response.status, response.reason,
+                        response.msg))
+
+                if response.will_close:
+                    break
+        except Exception, e:
+            connection.close()
+
+            if reused and not ret_val:
+                # The idle connection went stale; retry on a fresh connection.
+                return self.pipeline(url, requests)
+
+            ret_val.extend([e] * (len(requests) - len(ret_val)))
+        else:
+            if len(ret_val) < len(requests):
+                # The server stopped reading; resend the remaining requests.
+                connection.close()
+                ret_val.extend(self.pipeline(url, requests[len(ret_val):]))
+            elif response.will_close:
+                connection.close()
+            else:
+                self._release(connection)
+
+        return ret_val
+
+    def _acquire(self, deadline=None):
+        """Get an idle connection, or a new connection if none are idle.
+        Returns the connection and whether it is being reused.
+        """
+        now = time()
+
+        if self.pid != os.getpid():
+            # Connections inherited from the parent process are not shared.
+            self.pid = os.getpid()
+            self.close()
+
+        with self.lock:
+            while self.connections:
+                connection, used = self.connections.pop()
+
+                if now - used < self.idle_timeout:
+                    return connection, True
+
+                connection.close()
+
+        return self._create(deadline), False
+
+    def _create(self, deadline=None):
+        """Create a new connection.
+        """
+        timeout = self._timeout(self.connect_timeout, deadline)
+
+        if self.proxy is None:
+            ret_val = self.connection_class(self.host, self.port,
+                    timeout=timeout)
+        else:
+            ret_val = self.connection_class(self.proxy.hostname,
+                    self.proxy.port, timeout=timeout)
+
+            if self.connection_class is not HTTPConnection:
+                # Tunnel TLS to the host with CONNECT.
+                set_tunnel = getattr(ret_val, "set_tunnel", None)
+
+                if set_tunnel is not None:
+                    set_tunnel(self.host, self.port, self.proxy_headers)
+                else:  # Python 2.6 tunnels without proxy headers.
+                    ret_val._set_tunnel(self.host, self.port)
+
+        ret_val.connect()
+        ret_val.sock.settimeout(self.read_timeout)
+
+        return ret_val
+
+    def _deadline(self):
+        """Get the deadline for a POST, or ``None`` if there is no total
+        timeout.
+        """
+        if self.total_timeout:
+            ret_val = time() + self.total_timeout
+        else:
+            ret_val = None
+
+        return ret_val
+
+    def _format(self, path, headers, body):
+        """Format a POST request for pipelining.
+        """
+        lines = ["POST %s HTTP/1.1" % path, "Host: %s" % self.netloc,
+            "Accept-Encoding: identity", "Content-Length: %d" % len(body)]
+        lines.extend("%s: %s" % item for item in headers.iteritems())
+
+        return "%s\r\n\r\n%s" % ("\r\n".join(lines), body)
+
+    def _prepare(self, url, headers):
+        """Get the request path and headers for a POST to the given URL.
+        """
+        parts = urlsplit(url)
+        path = parts.path or "/"
+
+        if parts.query:
+            path = "%s?%s" % (path, parts.query)
+
+        if self.proxy is not None and \
+                self.connection_class is HTTPConnection:
+            # Plain HTTP proxies take the absolute URI.
+            path = "%s://%s%s" % (parts.scheme, parts.netloc, path)
+            headers = dict(headers, **self.proxy_headers)
+
+        return path, headers
+
+    @staticmethod
+    def _timeout(timeout, deadline):
+        """Get the given socket timeout, bounded by the time remaining until
+        the given deadline. Raises a :class:`socket.timeout` if the deadline
+        has passed.
+        """
+        if deadline is not None:
+            remaining = deadline - time()
+
+            if remaining <= 0:
+                raise socket.timeout("Exceptional delivery timed out.")
+
+            timeout = remaining if timeout is None else min(timeout, remaining)
+
+        return timeout
+
+    def _release(self, connection):
+        """Return the given connection to the idle pool.
+        """
+        with self.lock:
+            if len(self.connections) < self.size:
+                self.connections.append((connection, time()))
+                connection = None
+
+        if connection is not None:
+            connection.close()
+
+    @staticmethod
+    def _request(connection, path, body, headers, timeout):
+        """Issue a POST on the given connection and read the response.
+        """
+        connection.sock.settimeout(timeout)
+        connection.request("POST", path, body, headers)
+        ret_val = connection.getresponse()
+        ret_val.read()  # drain the response so the connection can be reused.
+
+        return ret_val
+
+
+class AgentClient(object):
+    """Connection to a local :class:`Agent` over a Unix domain socket. Error
+    data is written to the agent as a frame holding the error fingerprint
+    and the encoded data. The connection is reestablished on failure and in
+    processes forked after it was opened.
+
+    :param path: The agent socket path.
+    :param timeout: Default 5. The socket timeout in seconds.
+    """
+
+    def __init__(self, path, timeout=5):
+        """Create this agent client. The agent is connected to on first use.
+        """
+        self.path = path
+        self.timeout = timeout
+        self.sock = None
+        self.pid = None
+        self.lock = Lock()
+
+    def close(self):
+        """Close the connection to the agent.
+        """
+        with self.lock:
+            sock, self.sock = self.sock, None
+
+        if sock is not None:
+            sock.close()
+
+    def send(self, fingerprint, data):
+        """Send the given error data to the agent. Raises a
+        :class:`socket.error` if the agent is unreachable.
+
+        :param fingerprint: The error fingerprint, or ``None``.
+        :param data: The JSON encoded error data.
+        """
+        fingerprint = fingerprint or ""
+        frame = pack(">II", len(fingerprint), len(data)) + fingerprint + data
+
+        with self.lock:
+            if self.pid != os.getpid() and self.sock is not None:
+                self.sock.close()  # never share the parent's connection.
+                self.sock = None
+
+            reused = self.sock is not None
+
+            try:
+                if self.sock is None:
+                    self.sock = self._connect()
+
+                self.sock.sendall(frame)
+            except socket.error:
+                if self.sock is not None:
+                    self.sock.close()
+                    self.sock = None
+
+                if not reused:
+                    raise
+
+                # The agent closed the connection; retry on a new one.
+                self.sock = self._connect()
+                self.sock.sendall(frame)
+
+    def _connect(self):
+        """Connect to the agent.
+        """
+        ret_val = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        ret_val.settimeout(self.timeout)
+
+        try:
+            ret_val.connect(self.path)
+        except:
+            ret_val.close()
+            raise
+
+        self.pid = os.getpid()
+
+        return ret_val
+
+
+class Deduplicator(object):
+    """Suppresses repeated errors. Errors are identified by a fingerprint, and
+    only the first occurrence of a fingerprint within a time window is
+    reported. The next report after the window expires carries a rolled-up
+    count of the suppressed occurrences. If the error does not recur within
+    a further window, or its fingerprint is evicted, the count is emitted
+    with the first report by a background thread instead; counts still
+    pending when the interpreter exits are lost.
+
+    :param window: The number of seconds during which repeated fingerprints
+                   are suppressed.
+    :param size: Default 1000. The maximum number of fingerprints tracked.
+                 The oldest fingerprints are evicted first.
+    :param logger: Default ``None``. A logger for emit errors.
+    """
+
+    def __init__(self, window, size=1000, logger=None):
+        """Create this deduplicator.
+        """
+        self.window = window
+        self.size = size
+        self.logger = logger
+        self.entries = {}
+        self.order = deque()
+        self.pending = []
+        self.lock = Lock()
+        self.thread = None
+        self.pid = None
+        self.emit = None
+
+    def attach(self, fingerprint, report):
+        """Attach the given report to the tracked fingerprint it was
+        reported for, so that a count of suppressed occurrences can be
+        emitted with it.
+
+        :param fingerprint: The error fingerprint.
+        :param report: The reported :class:`Report`.
+        """
+        with self.lock:
+            entry = self.entries.get(fingerprint)
+
+            if entry is not None:
+                entry[2] = report
+
+    def check(self, fingerprint):
+        """Check the given fingerprint. Returns ``None`` if the error should
+        be suppressed, otherwise the number of occurrences the report
+        represents.
+
+        :param fingerprint: The error fingerprint.
+        """
+        now = time()
+
+        if self.emit is not None and self.pid != os.getpid():
+            self.start(self.emit)
+
+        with self.lock:
+            self._expire(now)
+            entry = self.entries.get(fingerprint)
+
+            if entry is not None and now - entry[0] < self.window:
+                entry[1] += 1
+                ret_val = None
+            else:
+                ret_val = 1 + (entry[1] if entry else 0)
+                self.entries[fingerprint] = [now, 0, None]
+                self.order.append((now, fingerprint))
+
+                while len(self.entries) > self.size:
+                    self._evict()
+
+        return ret_val
+
+    def expire(self):
+        """Stop tracking fingerprints with suppressed occurrences that did
+        not recur within a further window, or were evicted. Returns a list
+        of ``(report, count)`` pairs for them.
+        """
+        now = time()
+
+        with self.lock:
+            ret_val = self.pending
+            self.pending = []
+
+            for fingerprint, entry in self.entries.items():
+                if entry[1] and now - entry[0] >= self.window * 2:
+                    del self.entries[fingerprint]
+
+                    if entry[2] is not None:
+                        ret_val.append((entry[2], entry[1]))
+
+            self._expire(now)
+
+        return ret_val
+
+    def start(self, emit):
+        """Start the thread that emits expired counts. In a forked child
+        process, the thread is restarted on the next :meth:`check`.
+
+        :param emit: A callable accepting a reported :class:`Report` and the
+                     number of suppressed occurrences of its error.
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                self.emit = emit
+                self.pid = os.getpid()
+                self.thread = Thread(target=self._run, args=(emit,),
+                        name="flask-exceptional-deduplicator")
+                self.thread.daemon = True
+                self.thread.start()
+
+    def _evict(self):
+        """Evict the oldest tracked fingerprint.
+        """
+        seen, fingerprint = self.order.popleft()
+        entry = self.entries.get(fingerprint)
+
+        if entry is not None and entry[0] == seen:
+            del self.entries[fingerprint]
+
+            if entry[1] and entry[2] is not None and \
+                    len(self.pending) < self.size:
+                self.pending.append((entry[2], entry[1]))
+
+    def _expire(self, now):
+        """Evict fingerprints whose window expired without a suppressed
+        occurrence.
+        """
+        while self.order and now - self.order[0][0] >= self.window:
+            seen, fingerprint = self.order[0]
+            entry = self.entries.get(fingerprint)
+
+            if entry is not None and entry[0] == seen and entry[1]:
+                break  # keep the count for the next report.
+
+            self._evict()
+
+    def _run(self, emit):
+        """Emit expired counts until the interpreter exits.
+        """
+        while True:
+            sleep(self.window)
+
+            for report, count in self.expire():
+                try:
+                    emit(report, count)
+                except Exception:  # never let an emit error kill the thread.
+                    if self.logger:
+                        self.logger.exception("Exceptional summary failed.")
+
+
+class Spool(object):
+    """Append-only on-disk spool for error data. Spooled error data is
+    written to segment files in a directory and replayed oldest-first by a
+    background thread, backing off exponentially while the Exceptional API
+    remains unreachable. Once the spool exceeds its size cap, the oldest
+    segments are evicted.
+
+    :param directory: The directory to store segment files in.
+    :param size: Default 67108864. The maximum number of bytes spooled.
+    :param segment_size: Default 1048576. The maximum number of bytes per
+                         segment file.
+    :param interval: Default 5. The number of seconds between replays.
+    :param backoff: Default 300. The maximum number of seconds between
+                    replays while delivery is failing.
+    :param logger: Default ``None``. A logger for replay errors.
+    """
+
+    HEADER = ">IB"  # record length and content encoding.
+    HEADER_SIZE = 5
+    SUFFIX = ".spool"
+
+    def __init__(self, directory, size=67108864, segment_size=1048576,
+            interval=5, backoff=300, logger=None):
+        """Create this spool.
+        """
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        self.directory = directory
+        self.size = size
+        self.segment_size = segment_size
+        self.interval = interval
+        self.backoff = backoff
+        self.logger = logger
+        self.segment = None
+        self.pid = None
+        self.lock = Lock()
+        self.thread = None
+        self.thread_pid = None
+        self.send = None
+
+    def append(self, body, encoding):
+        """Append error data to the current segment file.
+
+        :param body: The (possibly compressed) error data.
+        :param encoding: The index of the error data content encoding in
+                         :data:`ENCODINGS`.
+        """
+        record = pack(self.HEADER, len(body), encoding) + body
+
+        if self.send is not None and self.thread_pid != os.getpid():
+            self.start(self.send)
+
+        with self.lock:
+            if self.segment is None or self.pid != os.getpid() or \
+                    (self.segment.tell() and self.segment.tell() +
+                    len(record) > self.segment_size):
+                self._rotate()
+
+            self.segment.write(record)
+            self.segment.flush()
+            self._evict()
+
+    def replay(self, send):
+        """Replay spooled error data oldest-first. Returns ``True`` if the
+        spool was drained, or ``False`` if delivery failed.
+
+        :param send: A callable accepting the error data and content encoding
+                     index. Returns ``False`` if the error data should be
+                     retried later.
+        """
+        with self.lock:
+            if self.segment is not None and self.segment.tell():
+                self._close()
+
+        for path in self._segments():
+            try:
+                segment = open(path, "r+b")
+            except IOError:
+                continue  # evicted or replayed by another process.
+
+            try:
+                if not self._lock(segment):
+                    continue
+
+                data = segment.read()
+                offset = 0
+
+                while offset + self.HEADER_SIZE <= len(data):
+                    length, encoding = unpack_from(self.HEADER, data,
+                            offset)
+                    start = offset + self.HEADER_SIZE
+                    end = start + length
+
+                    if end > len(data):
+                        break  # truncated by an interrupted write.
+
+                    if not send(data[start:end], encoding):
+                        self._replace(path, data[offset:])
+
+                        return False
+
+                    offset = end
+
+                os.remove(path)
+            finally:
+                segment.close()
+
+        return True
+
+    def start(self, send):
+        """Start the replay thread. In a forked child process, the thread is
+        restarted on the next :meth:`append`.
+
+        :param send: The callable used to replay error data. See
+                     :meth:`replay`.
+        """
+        with self.lock:
+            if self.thread_pid != os.getpid():
+                self.send = send
+                self.thread_pid = os.getpid()
+                self.thread = Thread(target=self._run, args=(send,),
+                        name="flask-exceptional-spool")
+                self.thread.daemon = True
+                self.thread.start()
+
+    def _close(self):
+        """Close the current segment file.
+        """
+        self.segment.close()  # releases the segment lock.
+        self.segment = None
+
+    def _evict(self):
+        """Remove the oldest segment files while the spool exceeds its size
+        cap. Segments in use are skipped.
+        """
+        segments = [(path, os.path.getsize(path))
+            for path in self._segments()]
+        total = sum(size for path, size in segments)
+
+        for path, size in segments:
+            if total <= self.size:
+                break
+
+            if path == self.segment.name:
+                continue
+
+            try:
+                with open(path, "rb") as segment:
+                    if self._lock(segment):
+                        os.remove(path)
+                        total -= size
+            except (IOError, OSError):
+                pass
+
+        if total > self.size and self.segment.tell():
+            # The current segment alone exceeds the cap.
+            os.remove(self.segment.name)
+            self._close()
+
+    @staticmethod
+    def _lock(segment):
+        """Try to lock the given segment file. Returns ``False`` if the
+        segment is locked by another writer or replayer.
+        """
+        if fcntl is None:
+            ret_val = True
+        else:
+            try:
+                fcntl.flock(segment.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                ret_val = True
+            except IOError:
+                ret_val = False
+
+        return ret_val
+
+    @staticmethod
+    def _replace(path, data):
+        """Atomically replace the contents of a segment file.
+        """
+        temporary = "%s.tmp" % path
+
+        with open(temporary, "wb") as segment:
+            segment.write(data)
+
+        os.rename(temporary, path)
+
+    def _rotate(self):
+        """Start a new segment file.
+        """
+        if self.segment is not None:
+            self._close()
+
+        name = "%020d-%010d%s" % (time() * 1000000, os.getpid(), self.SUFFIX)
+        self.segment = open(os.path.join(self.directory, name), "ab")
+        self.pid = os.getpid()
+        self._lock(self.segment)
+
+    def _run(self, send):
+        """Replay spooled error data until the interpreter exits.
+        """
+        delay = self.interval
+
+        while True:
+            sleep(delay)
+
+            try:
+                drained = self.replay(send)
+            except Exception:
+                drained = False
+
+                if self.logger:
+                    self.logger.exception("Exceptional spool replay failed.")
+
+            delay = self.interval if drained else min(delay * 2,
+                    self.backoff)
+
+    def _segments(self):
+        """Get the segment file paths, oldest first.
+        """
+        names = sorted(name for name in os.listdir(self.directory)
+            if name.endswith(self.SUFFIX))
+
+        return [os.path.join(self.directory, name) for name in names]
+
+
+class TokenBucket(object):
+    """Token bucket rate limit.
+
+    :param rate: The number of tokens added per second.
+    :param burst: The maximum number of tokens held.
+    """
+
+    def __init__(self, rate, burst):
+        """Create this token bucket.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time()
+        self.lock = Lock()
+
+    @property
+    def full(self):
+        """Determine whether this bucket has refilled completely.
+        """
+        return self.tokens + (time() - self.updated) * self.rate >= self.burst
+
+    def consume(self):
+        """Take a token from this bucket. Returns ``False`` if no token is
+        available.
+        """
+        with self.lock:
+            now = time()
+            self.tokens = min(self.burst,
+                    self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                ret_val = True
+            else:
+                ret_val = False
+
+        return ret_val
+
+
+class RateLimiter(object):
+    """Limits the rate of reported errors, both globally and per error
+    fingerprint. Either limit may be disabled by passing a ``None`` rate.
+
+    :param rate: The number of errors reported per second.
+    :param burst: The number of errors that may be reported in a burst.
+    :param fingerprint_rate: The number of errors reported per second for a
+                             single fingerprint.
+    :param fingerprint_burst: The number of errors that may be reported in a
+                              burst for a single fingerprint.
+    :param size: Default 1000. The maximum number of fingerprints tracked.
+    """
+
+    def __init__(self, rate, burst, fingerprint_rate, fingerprint_burst,
+            size=1000):
+        """Create this rate limiter.
+        """
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.fingerprint_rate = fingerprint_rate
+        self.fingerprint_burst = fingerprint_burst
+        self.size = size
+        self.buckets = {}
+        self.limited = 0
+        self.lock = Lock()
+
+    def allow(self, fingerprint=None):
+        """Determine whether an error may be reported.
+
+        :param fingerprint: Default ``None``. The error fingerprint.
+        """
+        ret_val = True
+
+        if self.fingerprint_rate and fingerprint is not None:
+            with self.lock:
+                bucket = self.buckets.get(fingerprint)
+
+                if bucket is None:
+                    if len(self.buckets) >= self.size:
+                        self._evict()
+
+                    bucket = self.buckets[fingerprint] = TokenBucket(
+                        self.fingerprint_rate, self.fingerprint_burst)
+
+            ret_val = bucket.consume()
+
+        if ret_val and self.bucket is not None:
+            ret_val = self.bucket.consume()
+
+        if not ret_val:
+            self.limited += 1
+
+        return ret_val
+
+    def _evict(self):
+        """Discard fingerprint buckets that have refilled, since they are
+        equivalent to new buckets. If none have, discard all of them.
+        """
+        for fingerprint, bucket in self.buckets.items():
+            if bucket.full:
+                del self.buckets[fingerprint]
+
+        if len(self.buckets) >= self.size:
+            self.buckets.clear()
+
+
+class CircuitBreaker(object):
+    """Circuit breaker for delivering error data. The circuit opens after a
+    number of consecutive delivery failures, and delivery is skipped while
+    it is open. Once the reset timeout expires, a single delivery is allowed
+    through as a probe; its outcome closes or re-opens the circuit.
+
+    :param threshold: Default 5. The number of consecutive failures that
+                      opens the circuit.
+    :param reset_timeout: Default 30. The number of seconds the circuit stays
+                          open before probing.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        """Create this circuit breaker.
+        """
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = None
+        self.skipped = 0
+        self.lock = Lock()
+
+    def allow(self):
+        """Determine whether delivery may be attempted.
+        """
+        with self.lock:
+            if self.state == self.CLOSED:
+                ret_val = True
+            elif self.state == self.OPEN and \
+                    time() - self.opened >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                ret_val = True
+            else:
+                ret_val = False
+                self.skipped += 1
+
+        return ret_val
+
+    def failure(self):
+        """Record a failed delivery.
+        """
+        with self.lock:
+            self.failures += 1
+
+            if self.state == self.HALF_OPEN or \
+                    self.failures >= self.threshold:
+                self.state = self.OPEN
+                self.opened = time()
+
+    def success(self):
+        """Record a successful delivery.
+        """
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+
+class Retrier(object):
+    """Scheduler for retrying failed error data deliveries on a daemon thread,
+    off the request thread. Retries back off exponentially, capped at
+    ``max_backoff`` seconds, with full jitter so that processes recovering
+    from the same outage do not retry in lockstep. Each report gets at most
+    ``retries`` retries, and at most ``size`` retries are pending at once, so
+    retrying cannot amplify an outage.
+
+    :param send: The callable to retry, called with the scheduled arguments
+                 and the retry number.
+    :param retries: Default 3. The maximum number of retries per report.
+    :param backoff: Default 0.5. The base number of seconds to back off.
+    :param max_backoff: Default 30. The maximum number of seconds to back
+                        off; a longer ``Retry-After`` is not honored.
+    :param size: Default 1000. The maximum number of pending retries.
+    :param logger: Default ``None``. A logger for retry errors.
+    """
+
+    def __init__(self, send, retries=3, backoff=0.5, max_backoff=30,
+            size=1000, logger=None):
+        """Create this retrier. The thread is started on first use.
+        """
+        self.send = send
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.size = size
+        self.logger = logger
+        self.heap = []
+        self.sequence = 0
+        self.scheduled = 0
+        self.exhausted = 0
+        self.condition = Condition()
+        self.thread = None
+        self.pid = None
+
+    def delay(self, attempt, retry_after=None):
+        """Get the number of seconds to wait before the given retry, or
+        ``None`` if the API asked to wait longer than ``max_backoff``.
+
+        :param attempt: The retry number, starting at 1.
+        :param retry_after: Default ``None``. The number of seconds the API
+                            asked to wait.
+        """
+        if retry_after is None:
+            ret_val = random() * min(self.max_backoff,
+                    self.backoff * 2 ** (attempt - 1))
+        elif retry_after <= self.max_backoff:
+            ret_val = max(retry_after, 0)
+        else:
+            ret_val = None
+
+        return ret_val
+
+    def schedule(self, args, attempt, retry_after=None):
+        """Schedule a retry. Returns ``False`` if the retry budget of the
+        report, or of this retrier, is exhausted.
+
+        :param args: The tuple of arguments to retry with.
+        :param attempt: The retry number, starting at 1.
+        :param retry_after: Default ``None``. The number of seconds the API
+                            asked to wait.
+        """
+        delay = self.delay(attempt, retry_after)
+
+        with self.condition:
+            if attempt > self.retries or delay is None or \
+                    len(self.heap) >= self.size:
+                self.exhausted += 1
+
+                return False
+
+            self.sequence += 1
+            self.scheduled += 1
+            heappush(self.heap, (time() + delay, self.sequence, args,
+                    attempt))
+            self.condition.notify()
+
+            if self.pid != os.getpid():  # first use, or forked.
+                self.pid = os.getpid()
+                self.thread = Thread(target=self._run,
+                        name="flask-exceptional-retrier")
+                self.thread.daemon = True
+                self.thread.start()
+
+        return True
+
+    def drain(self):
+        """Remove all pending retries. Returns the list of their argument
+        tuples.
+        """
+        with self.condition:
+            ret_val = [item[2] for item in sorted(self.heap)]
+            del self.heap[:]
+
+        return ret_val
+
+    def _run(self):
+        """Send due retries until the interpreter exits.
+        """
+        while True:
+            with self.condition:
+                while not self.heap or self.heap[0][0] > time():
+                    if self.heap:
+                        self.condition.wait(self.heap[0][0] - time())
+                    else:
+                        self.condition.wait()
+
+                due, sequence, args, attempt = heappop(self.heap)
+
+            try:
+                self.send(*(args + (attempt,)))
+            except Exception:  # never let a delivery error kill the thread.
+                if self.logger:
+                    self.logger.exception("Exceptional retry failed.")
+
+
+class BatchStats(object):
+    """Statistics for the batches flushed by a :class:`Worker`.
+    """
+
+    def __init__(self):
+        """Create these batch statistics.
+        """
+        self.batches = 0
+        self.items = 0
+        self.bytes = 0
+        self.last_size = 0
+        self.max_size = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
+    @property
+    def mean_size(self):
+        """Get the mean number of items per batch.
+        """
+        return float(self.items) / self.batches if self.batches else 0.0
+
+    @property
+    def mean_latency(self):
+        """Get the mean number of seconds taken to flush a batch.
+        """
+        return self.total_latency / self.batches if self.batches else 0.0
+
+    def record(self, size, length, latency):
+        """Record a flushed batch.
+
+        :param size: The number of items in the batch.
+        :param length: The number of encoded bytes in the batch.
+        :param latency: The number of seconds taken to flush the batch.
+        """
+        self.batches += 1
+        self.items += size
+        self.bytes += length
+        self.last_size = size
+        self.max_size = max(self.max_size, size)
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        self.total_latency += latency
+
+
+class Submission(object):
+    """Handle for error data submitted to a :class:`Dispatcher`. The
+    submitting thread is never blocked; it may either :meth:`wait` for the
+    submission to complete or register a callback. Callbacks run on the
+    dispatcher thread, so event loop based consumers should hand the result
+    back to their loop, e.g. via ``loop.call_soon_threadsafe``.
+
+    :param callback: Default ``None``. A callable invoked with this
+                     submission once it completes.
+    """
+
+    def __init__(self, callback=None):
+        """Create this submission.
+        """
+        self.callback = callback
+        self.result = None
+        self.exception = None
+        self.event = Event()
+
+    def done(self):
+        """Determine whether this submission has completed.
+        """
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        """Wait for this submission to complete. Returns ``True`` if the
+        submission completed before the timeout expired.
+
+        :param timeout: Default ``None``. The number of seconds to wait.
+        """
+        self.event.wait(timeout)
+
+        return self.event.is_set()
+
+    def complete(self, result=None, exception=None):
+        """Complete this submission and invoke its callback.
+
+        :param result: Default ``None``. The submission result.
+        :param exception: Default ``None``. The exception raised by the
+                          submission, if any.
+        """
+        self.result = result
+        self.exception = exception
+        self.event.set()
+
+        if self.callback is not None:
+            self.callback(self)
+
+
+class Dispatcher(object):
+    """Pool of daemon threads for delivering error data off the calling
+    thread. At most ``limit`` submissions are in flight at once; further
+    submissions wait in a queue of up to ``size`` items, and are completed
+    right away with a :class:`Queue.Full` exception once it is full.
+
+    :param limit: Default 10. The maximum number of in-flight submissions.
+    :param size: Default 100. The maximum number of waiting submissions.
+    :param logger: Default ``None``. A logger for callback errors.
+    """
+
+    def __init__(self, limit=10, size=100, logger=None):
+        """Create this dispatcher. Threads are started on first use.
+        """
+        self.limit = limit
+        self.queue = Queue(size)
+        self.logger = logger
+        self.rejected = 0
+        self.threads = []
+        self.pid = None
+        self.lock = Lock()
+
+    def submit(self, function, args=(), callback=None):
+        """Submit the given function for calling on a dispatcher thread.
+        Returns a :class:`Submission` for the call result.
+
+        :param function: The callable to call.
+        :param args: Default ``()``. The arguments to call the function with.
+        :param callback: Default ``None``. A callable invoked with the
+                         :class:`Submission` once it completes.
+        """
+        ret_val = Submission(callback)
+
+        if len(self.threads) < self.limit or self.pid != os.getpid():
+            self._start()
+
+        try:
+            self.queue.put_nowait((function, args, ret_val))
+        except Full, e:
+            self.rejected += 1
+            self._complete(ret_val, exception=e)
+
+        return ret_val
+
+    def _complete(self, submission, result=None, exception=None):
+        """Complete the given submission.
+        """
+        try:
+            submission.complete(result, exception)
+        except Exception:  # never let a callback error kill the thread.
+            if self.logger:
+                self.logger.exception("Exceptional callback failed.")
+
+    def _run(self):
+        """Call submitted functions until the interpreter exits.
+        """
+        while True:
+            function, args, submission = self.queue.get()
+
+            try:
+                result = function(*args)
+            except Exception, e:
+                self._complete(submission, exception=e)
+            else:
+                self._complete(submission, result)
+            finally:
+                self.queue.task_done()
+
+    def _start(self):
+        """Start the dispatcher threads. In a forked child process, the
+        threads are restarted with an empty queue.
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                if self.threads:  # forked; the parent runs its own calls.
+                    self.queue = Queue(self.queue.maxsize)
+                    self.threads = []
+
+                self.pid = os.getpid()
+
+            while len(self.threads) < self.limit:
+                thread = Thread(target=self._run,
+                        name="flask-exceptional-dispatcher")
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+
+class Histogram(object):
+    """Latency histogram with fixed buckets.
+
+    :param buckets: Default :attr:`BUCKETS`. The ascending bucket upper
+                    bounds in seconds.
+    """
+
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+            0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, buckets=BUCKETS):
+        """Create this histogram.
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last counts overflow.
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    @property
+    def mean(self):
+        """Get the mean observed latency in seconds.
+        """
+        return self.total / self.count if self.count else 0.0
+
+    def observe(self, latency):
+        """Record an observed latency.
+
+        :param latency: The latency in seconds.
+        """
+        self.counts[bisect_left(self.buckets, latency)] += 1
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def percentile(self, percent):
+        """Get the upper bound of the bucket holding the given percentile of
+        observed latencies, or ``None`` if it overflows the buckets.
+
+        :param percent: The percentile, from 0 to 100.
+        """
+        rank = self.count * percent / 100.0
+        seen = 0
+
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+
+            if seen >= rank:
+                return bound
+
+        return None
+
+
+class Metrics(object):
+    """Counters and latency histograms for the error reporting pipeline.
+    Latencies are recorded for the ``'capture'``, ``'filter'``, ``'encode'``,
+    ``'compress'`` and ``'send'`` stages, and for the total time an error
+    adds to the ``'request'``. Counters are kept for errors ``'reported'``,
+    ``'suppressed'``, ``'queued'``, ``'dropped'``, ``'sent'``, ``'failed'``,
+    ``'spooled'`` and answered with a ``'bad_status'`` line.
+
+    :param logger: Default ``None``. A logger for callback errors.
+    """
+
+    def __init__(self, logger=None):
+        """Create these metrics.
+        """
+        self.counters = {}
+        self.histograms = {}
+        self.callbacks = []
+        self.logger = logger
+        self.lock = Lock()
+
+    def connect(self, callback):
+        """Connect a callback, e.g. to forward metrics to a metrics service.
+        The callback is invoked with the metric kind (``'counter'`` or
+        ``'latency'``), name and value on every update.
+
+        :param callback: The callable to connect.
+        """
+        self.callbacks.append(callback)
+
+    def increment(self, name, value=1):
+        """Increment a counter.
+
+        :param name: The counter name.
+        :param value: Default 1. The amount to increment by.
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+        self._notify("counter", name, value)
+
+    def observe(self, name, latency):
+        """Record a latency.
+
+        :param name: The histogram name.
+        :param latency: The latency in seconds.
+        """
+        with self.lock:
+            histogram = self.histograms.get(name)
+
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+
+            histogram.observe(latency)
+
+        self._notify("latency", name, latency)
+
+    def _notify(self, kind, name, value):
+        """Invoke the connected callbacks with the given update. A failing
+        callback is logged, never raised into the reporting pipeline.
+        """
+        for callback in self.callbacks:
+            try:
+                callback(kind, name, value)
+            except Exception:
+                if self.logger:
+                    self.logger.exception("Exceptional metrics callback failed.")  # NOQA
+
+
+class Worker(object):
+    """Background thread for delivering error data to Exceptional. Request
+    threads hand off :class:`Report` snapshots via :meth:`put` and return
+    right away; the worker thread encodes the queued reports and delivers
+    them in batches. A batch is flushed once it reaches ``batch_size``
+    reports, ``batch_bytes`` bytes of encoded data, or is ``batch_age``
+    seconds old. The Exceptional API accepts one report per request, so a
+    batch is pipelined: every request is written before any response is
+    read.
+
+    :param send: The callable used to deliver each queued report.
+    :param size: Default 100. The maximum number of queued items.
+    :param drop: Default ``'newest'``. Which item to discard when the queue
+                 is full - either the ``'newest'`` (incoming) item or the
+                 ``'oldest'`` queued item.
+    :param flush_timeout: Default 5. The number of seconds to wait for the
+                          queue to drain on interpreter shutdown.
+    :param logger: Default ``None``. A logger for delivery errors.
+    :param batch_size: Default 1. The maximum number of items per batch.
+    :param batch_bytes: Default 1048576. The maximum number of encoded bytes
+                        per batch.
+    :param batch_age: Default 1. The maximum number of seconds an item waits
+                      for its batch to fill.
+    :param send_batch: Default ``None``. The callable used to deliver a batch
+                       of more than one report at once, otherwise each report
+                       is delivered with ``send``.
+    """
+
+    def __init__(self, send, size=100, drop="newest", flush_timeout=5,
+            logger=None, batch_size=1, batch_bytes=1048576, batch_age=1,
+            send_batch=None):
+        """Create this worker.
+        """
+        if drop not in ("newest", "oldest"):
+            raise ValueError("Invalid queue drop policy %r." % drop)
+
+        self.send = send
+        self.send_batch = send_batch
+        self.queue = Queue(size)
+        self.drop = drop
+        self.flush_timeout = flush_timeout
+        self.logger = logger
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.batch_age = batch_age
+        self.stats = BatchStats()
+        self.dropped = 0
+        self.thread = None
+        self.pid = None
+        self.lock = Lock()
+
+    def start(self):
+        """Start the worker thread, and register a flush of any queued items
+        on interpreter shutdown. In a forked child process, e.g. a preloaded
+        gunicorn worker, the thread is restarted with an empty queue.
+        """
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+
+            if self.thread is None:
+                atexit.register(self.flush)
+            else:  # forked; the parent delivers its own queued items.
+                self.queue = Queue(self.queue.maxsize)
+
+            self.pid = os.getpid()
+            self.thread = Thread(target=self._run,
+                    name="flask-exceptional-worker")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def put(self, report):
+        """Queue the given report for delivery. Returns ``False`` if a report
+        was dropped because the queue was full.
+
+        :param report: The :class:`Report` to deliver.
+        """
+        if self.thread is not None and self.pid != os.getpid():
+            self.start()
+
+        try:
+            self.queue.put_nowait(report)
+            ret_val = True
+        except Full:
+            self.dropped += 1
+            ret_val = False
+
+            if self.drop == "oldest":
+                try:
+                    self.queue.get_nowait()
+                    self.queue.task_done()
+                except Empty:
+                    pass
+
+                try:
+                    self.queue.put_nowait(report)
+                except Full:
+                    pass
+
+        return ret_val
+
+    def flush(self, timeout=None):
+        """Wait for all queued items to be delivered, including any partially
+        filled batch. Returns ``True`` if the queue was drained before the
+        timeout expired.
+
+        :param timeout: Default ``None``. The number of seconds to wait,
+                        otherwise :attr:`flush_timeout` is used.
+        """
+        if self.thread is not None and self.pid != os.getpid():
+            return True  # forked; the parent flushes its own queued items.
+
+        if timeout is None:
+            timeout = self.flush_timeout
+
+        deadline = time() + timeout
+
+        if self.thread is not None and self.thread.is_alive():
+            try:
+                self.queue.put(_FLUSH, timeout=timeout)
+            except Full:
+                pass
+
+        condition = self.queue.all_tasks_done
+
+        with condition:
+            while self.queue.unfinished_tasks:
+                remaining = deadline - time()
+
+                if remaining <= 0:
+                    break
+
+                condition.wait(remaining)
+
+            ret_val = not self.queue.unfinished_tasks
+
+        return ret_val
+
+    def _flush(self, batch):
+        """Deliver the given batch of items.
+        """
+        start = time()
+        length = 0
+
+        if self.send_batch is not None and len(batch) > 1:
+            deliveries = [(self.send_batch, batch, batch)]
+        else:
+            deliveries = [(self.send, report, [report]) for report in batch]
+
+        for send, item, reports in deliveries:
+            try:
+                length += sum(len(report.data) for report in reports)
+                send(item)
+            except Exception:  # never let a delivery error kill the worker.
+                if self.logger:
+                    self.logger.exception("Exceptional delivery failed.")
+            finally:
+                for report in reports:
+                    self.queue.task_done()
+
+        self.stats.record(len(batch), length, time() - start)
+
+    def _run(self):
+        """Deliver queued items until the interpreter exits.
+        """
+        batch = []
+        length = 0
+        deadline = None
+
+        while True:
+            try:
+                if batch:
+                    report = self.queue.get(timeout=max(deadline - time(), 0))
+                else:
+                    report = self.queue.get()
+            except Empty:
+                report = _FLUSH
+            else:
+                if report is _FLUSH:
+                    self.queue.task_done()
+                else:
+                    if not batch:
+                        deadline = time() + self.batch_age
+
+                    batch.append(report)
+
+                    try:
+                        length += len(report.data)
+                    except Exception:
+                        if self.logger:
+                            self.logger.exception("Exceptional encoding failed.")  # NOQA
+
+            if batch and (report is _FLUSH or len(batch) >= self.batch_size or
+                    length >= self.batch_bytes):
+                self._flush(batch)
+                batch = []
+                length = 0
 
 
 class Exceptional(object):
@@ -49,19 +1970,28 @@ class Exceptional(object):
     def __init__(self, app=None):
         """Create this Exceptional extension.
         """
+        self.__application_cache = None
+        self.__reference = None
+
         if app is not None:
             self.init_app(app)
 
     @property
     def __version__(self):
-        """Get the version for this extension.
+        """Get the version for this extension. The version is looked up once
+        and memoized.
         """
-        if pkg_resources:
-            ret_val = pkg_resources.get_distribution("flask-exceptional").version  # NOQA
-        else:
-            ret_val = "unknown"
+        global _version
 
-        return ret_val
+        if _version is None:
+            pkg_resources = _get_pkg_resources()
+
+            if pkg_resources:
+                _version = pkg_resources.get_distribution("flask-exceptional").version  # NOQA
+            else:
+                _version = "unknown"
+
+        return _version
 
     def init_app(self, app):
         """Initialize this Exceptional extension.
@@ -78,7 +2008,85 @@ class Exceptional(object):
             app.config.setdefault("EXCEPTIONAL_HTTP_CODES",
                     set(xrange(400, 418)))
             app.config.setdefault("EXCEPTIONAL_DEBUG_URL", None)
+            app.config.setdefault("EXCEPTIONAL_SAMPLE_RATES", {})
+            app.config.setdefault("EXCEPTIONAL_ENDPOINT_SAMPLE_RATES", {})
+            app.config.setdefault("EXCEPTIONAL_MAX_FRAMES", 200)
+            app.config.setdefault("EXCEPTIONAL_MAX_MESSAGE_BYTES", 10240)
+            app.config.setdefault("EXCEPTIONAL_MAX_BODY_BYTES", 65536)
+            app.config.setdefault("EXCEPTIONAL_MAX_PARAMETERS", 200)
+            app.config.setdefault("EXCEPTIONAL_MAX_VALUE_BYTES", 4096)
+
+            for name in FILTERS:
+                if app.config[name]:
+                    Filter.get(app.config[name])  # precompile.
+
+            app.config.setdefault("EXCEPTIONAL_BACKGROUND", False)
+            app.config.setdefault("EXCEPTIONAL_QUEUE_SIZE", 100)
+            app.config.setdefault("EXCEPTIONAL_QUEUE_DROP", "newest")
+            app.config.setdefault("EXCEPTIONAL_QUEUE_FLUSH_TIMEOUT", 5)
+            app.config.setdefault("EXCEPTIONAL_MAX_IN_FLIGHT", 10)
+            app.config.setdefault("EXCEPTIONAL_BATCH_SIZE", 1)
+            app.config.setdefault("EXCEPTIONAL_BATCH_BYTES", 1048576)
+            app.config.setdefault("EXCEPTIONAL_BATCH_AGE", 1)
+            app.config.setdefault("EXCEPTIONAL_DEDUPE_WINDOW", 0)
+            app.config.setdefault("EXCEPTIONAL_DEDUPE_SIZE", 1000)
+            app.config.setdefault("EXCEPTIONAL_DEDUPE_FRAMES", 3)
+            app.config.setdefault("EXCEPTIONAL_RATE_LIMIT", None)
+            app.config.setdefault("EXCEPTIONAL_RATE_BURST", 10)
+            app.config.setdefault("EXCEPTIONAL_FINGERPRINT_RATE_LIMIT", None)
+            app.config.setdefault("EXCEPTIONAL_FINGERPRINT_RATE_BURST", 1)
+            app.config.setdefault("EXCEPTIONAL_CIRCUIT_THRESHOLD", 5)
+            app.config.setdefault("EXCEPTIONAL_CIRCUIT_RESET", 30)
+            app.config.setdefault("EXCEPTIONAL_SPOOL_DIRECTORY", None)
+            app.config.setdefault("EXCEPTIONAL_SPOOL_MODE", "failed")
+            app.config.setdefault("EXCEPTIONAL_SPOOL_SIZE", 67108864)
+            app.config.setdefault("EXCEPTIONAL_SPOOL_SEGMENT_SIZE", 1048576)
+            app.config.setdefault("EXCEPTIONAL_SPOOL_INTERVAL", 5)
+            app.config.setdefault("EXCEPTIONAL_SPOOL_BACKOFF", 300)
+            app.config.setdefault("EXCEPTIONAL_POOL_SIZE", 4)
+            app.config.setdefault("EXCEPTIONAL_POOL_IDLE_TIMEOUT", 60)
+            app.config.setdefault("EXCEPTIONAL_CONNECT_TIMEOUT", 5)
+            app.config.setdefault("EXCEPTIONAL_READ_TIMEOUT", 10)
+            app.config.setdefault("EXCEPTIONAL_TOTAL_TIMEOUT", 30)
+            app.config.setdefault("EXCEPTIONAL_DEADLINE", None)
+            app.config.setdefault("EXCEPTIONAL_RETRIES", 3)
+            app.config.setdefault("EXCEPTIONAL_RETRY_BACKOFF", 0.5)
+            app.config.setdefault("EXCEPTIONAL_RETRY_MAX_BACKOFF", 30)
+            app.config.setdefault("EXCEPTIONAL_AGENT_SOCKET", None)
+            app.config.setdefault("EXCEPTIONAL_COMPRESSION", "deflate")
+            app.config.setdefault("EXCEPTIONAL_COMPRESSION_LEVEL", 1)
+            app.config.setdefault("EXCEPTIONAL_COMPRESSION_THRESHOLD", 0)
+            app.config.setdefault("EXCEPTIONAL_ENVIRONMENT_REFERENCE", None)
+            app.config.setdefault("EXCEPTIONAL_METRICS", False)
+            level = app.config["EXCEPTIONAL_COMPRESSION_LEVEL"]
+
+            # Validate before any delivery threads start.
+            if app.config["EXCEPTIONAL_COMPRESSION"] not in ENCODINGS:
+                raise ValueError("Invalid compression %r." %
+                        app.config["EXCEPTIONAL_COMPRESSION"])
+
+            if isinstance(level, bool) or \
+                    not isinstance(level, (int, long)) or \
+                    not 0 <= level <= 9:
+                raise ValueError("Invalid compression level %r." % level)
+
+            if app.config["EXCEPTIONAL_ENVIRONMENT_REFERENCE"] not in (None,
+                    "process", "batch"):
+                raise ValueError("Invalid environment reference mode %r." %
+                        app.config["EXCEPTIONAL_ENVIRONMENT_REFERENCE"])
+
+            if app.config["EXCEPTIONAL_SPOOL_MODE"] not in ("all", "failed"):
+                raise ValueError("Invalid spool mode %r." %
+                        app.config["EXCEPTIONAL_SPOOL_MODE"])
+
+            if app.config["EXCEPTIONAL_QUEUE_DROP"] not in ("newest",
+                    "oldest"):
+                raise ValueError("Invalid queue drop policy %r." %
+                        app.config["EXCEPTIONAL_QUEUE_DROP"])
+
             self.__protocol_version = 5  # Using zlib compression.
+            self.metrics = Metrics(app.logger) \
+                if app.config["EXCEPTIONAL_METRICS"] else None
 
             if app.debug:
                 self.url = app.config["EXCEPTIONAL_DEBUG_URL"]
@@ -91,6 +2099,97 @@ class Exceptional(object):
                     self.__protocol_version
                 )
 
+            if self.url and app.config["EXCEPTIONAL_AGENT_SOCKET"]:
+                # The agent deduplicates, limits and delivers for the host.
+                self.agent = AgentClient(
+                    app.config["EXCEPTIONAL_AGENT_SOCKET"],
+                    timeout=app.config["EXCEPTIONAL_CONNECT_TIMEOUT"])
+            else:
+                self.agent = None
+
+            if self.url and not self.agent:
+                self.pool = ConnectionPool.get(self.url,
+                    size=app.config["EXCEPTIONAL_POOL_SIZE"],
+                    idle_timeout=app.config["EXCEPTIONAL_POOL_IDLE_TIMEOUT"],
+                    connect_timeout=app.config["EXCEPTIONAL_CONNECT_TIMEOUT"],
+                    read_timeout=app.config["EXCEPTIONAL_READ_TIMEOUT"],
+                    total_timeout=app.config["EXCEPTIONAL_TOTAL_TIMEOUT"])
+            else:
+                self.pool = None
+
+            if app.config["EXCEPTIONAL_DEDUPE_WINDOW"] and not self.agent:
+                self.deduplicator = Deduplicator(
+                    app.config["EXCEPTIONAL_DEDUPE_WINDOW"],
+                    size=app.config["EXCEPTIONAL_DEDUPE_SIZE"],
+                    logger=app.logger)
+
+                if self.url:
+                    self.deduplicator.start(self._summarize)
+            else:
+                self.deduplicator = None
+
+            if (app.config["EXCEPTIONAL_RATE_LIMIT"] or
+                    app.config["EXCEPTIONAL_FINGERPRINT_RATE_LIMIT"]) and \
+                    not self.agent:
+                self.limiter = RateLimiter(
+                    app.config["EXCEPTIONAL_RATE_LIMIT"],
+                    app.config["EXCEPTIONAL_RATE_BURST"],
+                    app.config["EXCEPTIONAL_FINGERPRINT_RATE_LIMIT"],
+                    app.config["EXCEPTIONAL_FINGERPRINT_RATE_BURST"])
+            else:
+                self.limiter = None
+
+            if self.pool and app.config["EXCEPTIONAL_CIRCUIT_THRESHOLD"]:
+                self.circuit = CircuitBreaker(
+                    app.config["EXCEPTIONAL_CIRCUIT_THRESHOLD"],
+                    app.config["EXCEPTIONAL_CIRCUIT_RESET"])
+            else:
+                self.circuit = None
+
+            if self.pool and app.config["EXCEPTIONAL_RETRIES"]:
+                self.retrier = Retrier(self._send,
+                    retries=app.config["EXCEPTIONAL_RETRIES"],
+                    backoff=app.config["EXCEPTIONAL_RETRY_BACKOFF"],
+                    max_backoff=app.config["EXCEPTIONAL_RETRY_MAX_BACKOFF"],
+                    size=app.config["EXCEPTIONAL_QUEUE_SIZE"],
+                    logger=app.logger)
+            else:
+                self.retrier = None
+
+            if self.url and app.config["EXCEPTIONAL_BACKGROUND"]:
+                self.worker = Worker(self._deliver,
+                    size=app.config["EXCEPTIONAL_QUEUE_SIZE"],
+                    drop=app.config["EXCEPTIONAL_QUEUE_DROP"],
+                    flush_timeout=app.config[
+                        "EXCEPTIONAL_QUEUE_FLUSH_TIMEOUT"],
+                    logger=app.logger,
+                    batch_size=app.config["EXCEPTIONAL_BATCH_SIZE"],
+                    batch_bytes=app.config["EXCEPTIONAL_BATCH_BYTES"],
+                    batch_age=app.config["EXCEPTIONAL_BATCH_AGE"],
+                    send_batch=self._deliver_batch)
+                self.worker.start()
+            else:
+                self.worker = None
+
+            self.dispatcher = Dispatcher(
+                limit=app.config["EXCEPTIONAL_MAX_IN_FLIGHT"],
+                size=app.config["EXCEPTIONAL_QUEUE_SIZE"],
+                logger=app.logger)
+
+            if self.pool and app.config["EXCEPTIONAL_SPOOL_DIRECTORY"]:
+                self.spool = Spool(app.config["EXCEPTIONAL_SPOOL_DIRECTORY"],
+                    size=app.config["EXCEPTIONAL_SPOOL_SIZE"],
+                    segment_size=app.config["EXCEPTIONAL_SPOOL_SEGMENT_SIZE"],
+                    interval=app.config["EXCEPTIONAL_SPOOL_INTERVAL"],
+                    backoff=app.config["EXCEPTIONAL_SPOOL_BACKOFF"],
+                    logger=app.logger)
+                self.spool.start(self._replay)
+
+                if self.retrier is not None:
+                    atexit.register(self._spool_retries)
+            else:
+                self.spool = None
+
             if not hasattr(app, "extensions"):
                 app.extensions = {}
 
@@ -103,6 +2202,15 @@ class Exceptional(object):
         else:
             app.logger.warning("Missing 'EXCEPTIONAL_API_KEY' configuration.")
 
+    @property
+    def stats(self):
+        """Get the :class:`BatchStats` for background delivery, or ``None``
+        if background delivery is disabled.
+        """
+        worker = getattr(self, "worker", None)
+
+        return worker.stats if worker else None
+
     @staticmethod
     def context(data=None, **kwargs):
         """Add extra context data to the current tracked exception. The context
@@ -133,185 +2241,791 @@ class Exceptional(object):
         :param config: A Flask application configuration object. Accepts either
                        :class:`flask.Config` or the object types allowed by
                        :meth:`flask.Config.from_object`.
-        :param traceback: A :class:`werkzeug.debug.tbtools.Traceback` instance
+        :param traceback: A :class:`Backtrace` or
+                          :class:`werkzeug.debug.tbtools.Traceback` instance
                           to publish.
         """
-        app = Flask(__name__)
-        exceptional = Exceptional()
+        return Publisher.get(config).publish(traceback)
+
+    @staticmethod
+    def publish_async(config, traceback=None, callback=None):
+        """Publish the given traceback to Exceptional without blocking the
+        calling thread. Error data is delivered by a :class:`Dispatcher` with
+        up to ``EXCEPTIONAL_MAX_IN_FLIGHT`` concurrent submissions. Returns a
+        :class:`Submission` whose result is the published error data.
+
+        :param config: A Flask application configuration object. Accepts either
+                       :class:`flask.Config` or the object types allowed by
+                       :meth:`flask.Config.from_object`.
+        :param traceback: Default ``None``. A :class:`Backtrace` or
+                          :class:`werkzeug.debug.tbtools.Traceback` instance
+                          to publish. The current exception is captured by
+                          default.
+        :param callback: Default ``None``. A callable invoked with the
+                         :class:`Submission` once it completes.
+        """
+        return Publisher.get(config).publish_async(traceback, callback)
+
+    @staticmethod
+    def test(config):
+        """Test the given Flask configuration. If configured correctly,
+        an error will be tracked by Exceptional for your app. Unlike
+        the initialized extension, this test will post data to Exceptional,
+        regardless of the configured ``DEBUG`` setting.
+
+        :param config: The Flask application configuration object to test.
+                       Accepts either :class:`flask.Config` or the object
+                       types allowed by :meth:`flask.Config.from_object`.
+        """
+        context = getattr(stack.top, "exceptional_context", None)
+        config = Publisher.load(config)
+        assert "EXCEPTIONAL_API_KEY" in config
+        config["DEBUG"] = False
+        config["TESTING"] = False
+        app = Publisher(config).app
+        app.testing = True
+
+        @app.route("/exception")
+        def exception():
+            setattr(stack.top, "exceptional_context", context)
+            message = "Congratulations! Your application is configured for Exceptional error tracking."  # NOQA
+
+            raise Exception(message)
+
+        with app.test_client() as client:
+            client.get("/exception")
+            json.loads(g.exceptional)
+
+    def refresh(self):
+        """Refresh the cached application environment data. The cache is
+        refreshed automatically when configuration values are added or
+        replaced, or the OS environment changes. Call this method after
+        mutating a configuration value in place or installing packages at
+        runtime.
+        """
+        self.__application_cache = None
+
+    def _get_application_json(self, app):
+        """Get the JSON encoded application environment data. The encoded
+        data is computed once and reused for subsequent errors until the
+        application configuration or OS environment changes.
+
+        :param app: The application to get environment data for.
+        """
+        filter = app.config.get("EXCEPTIONAL_ENVIRONMENT_FILTER")
+        signature = (
+            app.root_path,
+            [(name, id(value)) for name, value in app.config.iteritems()],
+            list(filter) if filter else None,
+            os.environ.items()
+        )
+        cache = self.__application_cache
+
+        if cache is None or cache[0] != signature:
+            data = _encoder.encode(self.__get_application_data(app))
+            cache = self.__application_cache = (signature, data,
+                    sha1(data).hexdigest())
+
+        return cache[1]
+
+    def _get_exception_handler(self, app):
+        """Get a wrapped exception handler. Returns a handler that can be
+        used to override Flask's ``app.handle_exception``. The wrapped
+        handler posts error data to Exceptional and then passes the exception
+        to the wrapped method.
+
+        :param app: The app for which the exception handler is being wrapped.
+        """
+        handle_exception = app.handle_exception
+
+        @wraps(handle_exception)
+        def ret_val(exception):
+            context = stack.top
+            sample_weight = self._sample(context, 500)
+
+            if sample_weight:
+                self._post_data(context, sample_weight=sample_weight)
+
+            return handle_exception(exception)
+
+        return ret_val
+
+    def _get_http_exception_handler(self, app):
+        """Get a wrapped HTTP exception handler. Returns a handler that can
+        be used to override Flask's ``app.handle_http_exception``. The wrapped
+        handler posts HTTP error (i.e. '400: Bad Request') data to Exceptional
+        and then passes the exception to the wrapped method.
+
+        :param app: The app for which the HTTP exception handler is being
+            wrapped.
+        """
+        handle_http_exception = app.handle_http_exception
+
+        @wraps(handle_http_exception)
+        def ret_val(exception):
+            context = stack.top
+
+            if exception.code in context.app.config["EXCEPTIONAL_HTTP_CODES"]:
+                sample_weight = self._sample(context, exception.code)
+
+                if sample_weight:
+                    self._post_data(context, sample_weight=sample_weight)
+
+            return handle_http_exception(exception)
+
+        return ret_val
+
+    @staticmethod
+    def _sample(context, code):
+        """Decide whether to report an error according to the configured
+        ``EXCEPTIONAL_SAMPLE_RATES`` and ``EXCEPTIONAL_ENDPOINT_SAMPLE_RATES``.
+        Returns the sample weight (the number of errors a report represents),
+        or ``None`` if the error should not be reported.
+
+        :param context: The current request context.
+        :param code: The HTTP status code of the error.
+        """
+        config = context.app.config
+        rate = config["EXCEPTIONAL_SAMPLE_RATES"].get(code, 1.0)
+        endpoint_rates = config["EXCEPTIONAL_ENDPOINT_SAMPLE_RATES"]
+
+        if endpoint_rates and context.request.endpoint:
+            rate *= endpoint_rates.get(context.request.endpoint, 1.0)
+
+        if rate >= 1:
+            ret_val = 1
+        elif rate > 0 and random() < rate:
+            ret_val = 1.0 / rate
+        else:
+            ret_val = None
+
+        return ret_val
+
+    def _post_data(self, context, traceback=None, sample_weight=1):
+        """POST data to the the Exceptional API. If DEBUG is True then data is
+        sent to ``EXCEPTIONAL_DEBUG_URL`` if it has been defined. If TESTING is
+        true, error data is stored in the global ``flask.g.exceptional``
+        variable.
+
+        :param context: The current application or application context.
+        :param traceback: Default ``None``. The exception stack trace, either
+                          a :class:`Backtrace` or a
+                          :class:`werkzeug.debug.tbtools.Traceback`. The
+                          current exception is captured by default.
+        :param sample_weight: Default 1. The number of errors this report
+                              represents when errors are sampled.
+
+        Returns the captured :class:`Report`, or ``None`` if the error was
+        suppressed.
+        """
+        if context:
+            if isinstance(context, Flask):
+                app = context
+                context = None
+            else:
+                app = context.app
+        else:
+            app = stack.top.app
+
+        metrics = self.metrics
+        start = time()
+
+        if metrics is not None:
+            metrics.increment("reported")
+
+        traceback = traceback or Backtrace.capture()
+
+        if self.deduplicator is not None or self.agent is not None or (
+                self.limiter is not None and self.limiter.fingerprint_rate):
+            if context and context.request.endpoint:
+                endpoint = context.request.endpoint
+            else:
+                endpoint = None
+
+            fingerprint = self._fingerprint(traceback, endpoint,
+                    app.config["EXCEPTIONAL_DEDUPE_FRAMES"])
+        else:
+            fingerprint = None
+
+        if self.deduplicator is not None:
+            occurrences = self.deduplicator.check(fingerprint)
+        else:
+            occurrences = 1
+
+        if occurrences is None or (self.limiter is not None and
+                not self.limiter.allow(fingerprint)):
+            if metrics is not None:
+                metrics.increment("suppressed")
+
+            return None
+
+        if context:
+            request = context.request
+            environ = dict((key, value) for key, value in
+                request.environ.iteritems() if isinstance(value, basestring))
+            context_data = getattr(context, "exceptional_context", None)
+            report = Report(self, app, traceback,
+                environ=environ,
+                endpoint=request.endpoint,
+                controller=request.blueprint if hasattr(request, "blueprint")
+                    else request.module,
+                parameters=self.__get_parameters(app, request),
+                session=dict(context.session),
+                context=dict(context_data) if context_data is not None
+                    else None,
+                occurrences=occurrences,
+                sample_weight=sample_weight,
+                fingerprint=fingerprint)
+        else:
+            report = Report(self, app, traceback, occurrences=occurrences,
+                sample_weight=sample_weight, fingerprint=fingerprint)
+
+        if self.deduplicator is not None:
+            self.deduplicator.attach(fingerprint, report)
+
+        if metrics is not None:
+            metrics.observe("capture", time() - start)
+
+        if context and app.testing:
+            g.exceptional = report.data
+
+        if self.url:
+            if self.worker is None:
+                if context and app.config["EXCEPTIONAL_DEADLINE"]:
+                    self._deliver_until(report,
+                            start + app.config["EXCEPTIONAL_DEADLINE"])
+                else:
+                    self._deliver(report)
+            elif self.worker.put(report):
+                if metrics is not None:
+                    metrics.increment("queued")
+            else:
+                if metrics is not None:
+                    metrics.increment("dropped")
+
+                app.logger.warning("Exceptional queue is full; error data dropped.")  # NOQA
+
+        if metrics is not None:
+            metrics.observe("request", time() - start)
+
+        return report
+
+    def _publish(self, app, traceback):
+        """Publish the given traceback for the given application. Returns the
+        published error data.
+        """
+        report = self._post_data(app, traceback=traceback)
+
+        return report.data if report is not None else None
+
+    def _deliver(self, report):
+        """Send the error data for the given report to the Exceptional API,
+        or to the local agent if one is configured.
+
+        :param report: The :class:`Report` to send.
+        """
+        if self.agent is None:
+            self._send(report.app, report.data)
+        else:
+            data = report.data
+
+            try:
+                self.agent.send(report.fingerprint, data)
+                outcome = "sent"
+            except socket.error:
+                outcome = "dropped"
+                message = "Unable to connect to the Exceptional agent at %s. %d bytes of error data dropped."  # NOQA
+                report.app.logger.warning(message, self.agent.path,
+                        len(data), exc_info=True)
+
+            if self.metrics is not None:
+                self.metrics.increment(outcome)
+
+    def _deliver_batch(self, reports):
+        """Send the error data for the given batch of reports to the
+        Exceptional API, pipelined over a single connection. Reports are sent
+        one by one to a local agent, in environment reference mode (each
+        reference depends on the previous response), while the circuit is
+        not closed, or in ``'all'`` spool mode.
+
+        :param reports: The list of :class:`Report` objects to send.
+        """
+        app = reports[0].app
+
+        if self.agent is not None or self.pool is None or \
+                app.config["EXCEPTIONAL_ENVIRONMENT_REFERENCE"] or \
+                (self.circuit is not None and
+                self.circuit.state != CircuitBreaker.CLOSED) or \
+                (self.spool is not None and
+                app.config["EXCEPTIONAL_SPOOL_MODE"] == "all") or \
+                any(report.app is not app for report in reports):
+            for report in reports:
+                self._deliver(report)
+
+            return
+
+        metrics = self.metrics
+        requests = []
+
+        for report in reports:
+            start = time()
+            body, encoding = self._compress(app, report.data)
+            requests.append((body, self._get_headers(encoding)))
+
+            if metrics is not None:
+                metrics.observe("compress", time() - start)
+
+        start = time()
+        responses = self.pool.pipeline(self.url, requests)
+
+        if metrics is not None:
+            metrics.observe("send", time() - start)
+
+        for report, response in zip(reports, responses):
+            self._send(app, report.data, response=response)
+
+    def _deliver_until(self, report, deadline):
+        """Send the error data for the given report from a dispatcher thread,
+        waiting for it to be sent until the given deadline. Delivery continues
+        in the background once the deadline passes.
+
+        :param report: The :class:`Report` to send.
+        :param deadline: The time to wait until.
+        """
+        app = report.app
+        submission = self.dispatcher.submit(self._deliver, (report,))
+
+        if not submission.wait(max(deadline - time(), 0)):
+            app.logger.warning("Exceptional delivery exceeded the deadline; continuing in the background.")  # NOQA
+        elif isinstance(submission.exception, Full):
+            app.logger.warning("Exceptional dispatcher is full; error data dropped.")  # NOQA
+        elif submission.exception is not None:
+            raise submission.exception
+
+    def _summarize(self, report, count):
+        """Send a summary of the suppressed occurrences of an error that did
+        not recur after its deduplication window expired. The summary is the
+        given reported error data, carrying the number of occurrences.
+
+        :param report: The reported :class:`Report` for the error.
+        :param count: The number of suppressed occurrences.
+        """
+        error = json.loads(report.data)
+        error["exception"]["occurrences"] = count
+        summary = Report(self, report.app, None,
+                fingerprint=report.fingerprint, data=_encoder.encode(error))
+
+        if self.worker is None:
+            self._deliver(summary)
+        elif not self.worker.put(summary):
+            if self.metrics is not None:
+                self.metrics.increment("dropped")
+
+            report.app.logger.warning("Exceptional queue is full; error data dropped.")  # NOQA
+
+    def _encode(self, report):
+        """Get the JSON encoded error data for the given report.
+
+        :param report: The :class:`Report` to encode.
+        """
+        app = report.app
+        metrics = self.metrics
+
+        if metrics is not None:
+            start = time()
+
+        application_data = self._get_application_json(app)
+        client_data = {
+            "name": "flask-exceptional",
+            "version": self.__version__,
+            "protocol_version": self.__protocol_version
+        }
+
+        if report.environ is not None:
+            request_data = self.__get_request_data(app,
+                    BaseRequest(report.environ), report)
+        else:
+            request_data = None
+
+        if metrics is not None:
+            filtered = time()
+            metrics.observe("filter", filtered - start)
+
+        exception_data = self.__get_exception_data(report.traceback,
+                report.timestamp, app.config["EXCEPTIONAL_MAX_FRAMES"],
+                app.config["EXCEPTIONAL_MAX_MESSAGE_BYTES"])
+
+        if report.occurrences > 1:
+            exception_data["occurrences"] = report.occurrences
+
+        if report.sample_weight != 1:
+            exception_data["sample_weight"] = report.sample_weight
+
+        ret_val = _encoder.encode({
+            "client": client_data,
+            "request": request_data,
+            "exception": exception_data,
+            "context": report.context
+        })
+
+        if metrics is not None:
+            metrics.observe("encode", time() - filtered)
+
+        return '%s%s, %s' % (ENVIRONMENT_PREFIX, application_data,
+                ret_val[1:])
+
+    def _post(self, body, encoding):
+        """POST error data to the Exceptional API. Returns the response
+        headers, or raises a :class:`urllib2.HTTPError` for error responses.
+        The outcome is recorded by the circuit breaker, if any.
+
+        :param body: The (possibly compressed) JSON encoded error data.
+        :param encoding: The index of the error data content encoding in
+                         :data:`ENCODINGS`.
+        """
+        try:
+            response = self.pool.post(self.url, body,
+                    self._get_headers(encoding))
+        except BadStatusLine:
+            response = None  # the API is reachable, albeit misbehaving.
+        except Exception:  # e.g. ssl.CertificateError, a ValueError.
+            if self.circuit is not None:
+                self.circuit.failure()
+
+            raise
+
+        return self._check(response)
+
+    def _check(self, response):
+        """Check a response from the Exceptional API. Returns the response
+        headers, or raises a :class:`urllib2.HTTPError` for error responses.
+        The outcome is recorded by the circuit breaker, if any.
+
+        :param response: The response status, reason and headers as a tuple,
+                         ``None`` for a bad status line, or the exception
+                         raised for an unanswered request.
+        """
+        if isinstance(response, BadStatusLine):
+            response = None
+        elif isinstance(response, Exception):
+            if self.circuit is not None:
+                self.circuit.failure()
+
+            raise response
 
-        if isinstance(config, Config):
-            app.config = config
+        if response is None:
+            status = None
         else:
-            app.config.from_object(config)
+            status, reason, response_headers = response
+
+        if self.circuit is not None:
+            if status is not None and status >= 500:
+                self.circuit.failure()
+            else:
+                self.circuit.success()
 
-        exceptional.init_app(app)
+        if status is None:
+            raise BadStatusLine("")
+        elif status >= 400:
+            raise HTTPError(self.url, status, reason, response_headers, None)
 
-        return exceptional._post_data(app, traceback=traceback)
+        return response_headers
 
     @staticmethod
-    def test(config):
-        """Test the given Flask configuration. If configured correctly,
-        an error will be tracked by Exceptional for your app. Unlike
-        the initialized extension, this test will post data to Exceptional,
-        regardless of the configured ``DEBUG`` setting.
+    def _get_headers(encoding):
+        """Get the request headers for error data.
 
-        :param config: The Flask application configuration object to test.
-                       Accepts either :class:`flask.Config` or the object
-                       types allowed by :meth:`flask.Config.from_object`.
+        :param encoding: The index of the error data content encoding in
+                         :data:`ENCODINGS`.
         """
-        context = getattr(stack.top, "exceptional_context", None)
-        app = Flask(__name__)
-        exceptional = Exceptional()
+        ret_val = {"Content-Type": "application/json"}
 
-        if isinstance(config, Config):
-            app.config = config
-        else:
-            app.config.from_object(config)
+        if encoding:
+            ret_val["Content-Encoding"] = ENCODINGS[encoding]
 
-        assert "EXCEPTIONAL_API_KEY" in app.config
-        app.debug = False
-        app.testing = False
-        exceptional.init_app(app)
-        app.testing = True
+        return ret_val
 
-        @app.route("/exception")
-        def exception():
-            setattr(stack.top, "exceptional_context", context)
-            message = "Congratulations! Your application is configured for Exceptional error tracking."  # NOQA
+    def _post_json(self, app, data):
+        """Compress and POST the given error data to the Exceptional API.
+        Returns the response headers.
 
-            raise Exception(message)
+        :param app: The application the error data belongs to.
+        :param data: The JSON encoded error data.
+        """
+        metrics = self.metrics
 
-        with app.test_client() as client:
-            client.get("/exception")
-            json.loads(g.exceptional)
+        if metrics is None:
+            return self._post(*self._compress(app, data))
 
-    def _get_exception_handler(self, app):
-        """Get a wrapped exception handler. Returns a handler that can be
-        used to override Flask's ``app.handle_exception``. The wrapped
-        handler posts error data to Exceptional and then passes the exception
-        to the wrapped method.
+        start = time()
+        body, encoding = self._compress(app, data)
+        compressed = time()
+        metrics.observe("compress", compressed - start)
 
-        :param app: The app for which the exception handler is being wrapped.
+        try:
+            return self._post(body, encoding)
+        finally:
+            metrics.observe("send", time() - compressed)
+
+    def _post_error(self, app, data):
+        """POST error data to the Exceptional API. In environment reference
+        mode, error data carries the hash of its application environment
+        block, and once the API acknowledges the hash via the
+        :data:`REFERENCE_HEADER` response header, subsequent error data (in
+        the same process, or batch) carries only the hash. Error data is
+        sent in full if the API does not acknowledge references, or rejects
+        a reference it no longer knows.
+
+        :param app: The application the error data belongs to.
+        :param data: The JSON encoded error data.
         """
-        handle_exception = app.handle_exception
+        mode = app.config["EXCEPTIONAL_ENVIRONMENT_REFERENCE"]
+        cache = self.__application_cache
+        start = len(ENVIRONMENT_PREFIX)
 
-        @wraps(handle_exception)
-        def ret_val(exception):
-            self._post_data(stack.top)
+        if not mode or cache is None or not data.startswith(cache[1], start):
+            self._post_json(app, data)
 
-            return handle_exception(exception)
+            return
 
-        return ret_val
+        digest = cache[2]
 
-    def _get_http_exception_handler(self, app):
-        """Get a wrapped HTTP exception handler. Returns a handler that can
-        be used to override Flask's ``app.handle_http_exception``. The wrapped
-        handler posts HTTP error (i.e. '400: Bad Request') data to Exceptional
-        and then passes the exception to the wrapped method.
+        if mode == "process":
+            key = digest
+        elif self.worker is not None:
+            key = (digest, self.worker.stats.batches)
+        else:
+            key = None  # every error is its own batch.
 
-        :param app: The app for which the HTTP exception handler is being
-            wrapped.
-        """
-        handle_http_exception = app.handle_http_exception
+        if key is not None and key == self.__reference:
+            reference = '%s{"reference": "%s"}, %s' % (ENVIRONMENT_PREFIX,
+                    digest, data[start + len(cache[1]) + 2:])
 
-        @wraps(handle_http_exception)
-        def ret_val(exception):
-            context = stack.top
+            try:
+                self._post_json(app, reference)
 
-            if exception.code in context.app.config["EXCEPTIONAL_HTTP_CODES"]:
-                self._post_data(context)
+                return
+            except HTTPError, e:
+                if e.code >= 500:
+                    raise
 
-            return handle_http_exception(exception)
+                self.__reference = None  # the reference was forgotten.
 
-        return ret_val
+        data = '{"application_environment_hash": "%s", %s' % (digest,
+                data[1:])
+        headers = self._post_json(app, data)
 
-    def _post_data(self, context, traceback=None):
-        """POST data to the the Exceptional API. If DEBUG is True then data is
-        sent to ``EXCEPTIONAL_DEBUG_URL`` if it has been defined. If TESTING is
-        true, error data is stored in the global ``flask.g.exceptional``
-        variable.
+        if key is not None and headers.get(REFERENCE_HEADER) == digest:
+            self.__reference = key
 
-        :param context: The current application or application context.
-        :param traceback: Default ``None``. The exception stack trace.
+    def _replay(self, body, encoding):
+        """Replay spooled error data. Returns ``False`` if the error data
+        should be retried later.
+
+        :param body: The (possibly compressed) JSON encoded error data.
+        :param encoding: The index of the error data content encoding in
+                         :data:`ENCODINGS`.
         """
-        if context:
-            if isinstance(context, Flask):
-                app = context
-                context = None
-            else:
-                app = context.app
-        else:
-            app = stack.top.app
+        if self.circuit is not None and not self.circuit.allow():
+            return False
 
-        application_data = self.__get_application_data(app)
-        client_data = {
-            "name": "flask-exceptional",
-            "version": self.__version__,
-            "protocol_version": self.__protocol_version
-        }
+        try:
+            self._post(body, encoding)
+            ret_val = True
+        except BadStatusLine:
+            ret_val = True
+        except HTTPError, e:
+            ret_val = e.code < 500 and e.code != 429
+        except (socket.error, HTTPException):
+            ret_val = False
 
-        if context:
-            request_data = self.__get_request_data(app, context.request,
-                    context.session)
-            context_data = getattr(context, "exceptional_context", None)
+        return ret_val
+
+    def _send(self, app, data, attempt=0, response=None):
+        """Send encoded error data to the Exceptional API. Data is compressed
+        per the ``EXCEPTIONAL_COMPRESSION`` settings, unless the application is
+        in debug mode. If a spool is configured, data is written to the spool
+        when the API is unreachable, or always in ``'all'`` spool mode.
+        Transient failures (``5xx`` and ``429 Too Many Requests`` responses,
+        and connection errors) are retried in the background; other failures
+        are logged, never raised.
+
+        :param app: The application the error data belongs to.
+        :param data: The JSON encoded error data.
+        :param attempt: Default 0. The retry number.
+        :param response: Default ``None``. The response to a pipelined POST
+                         of the error data, see :meth:`_check`; otherwise
+                         the error data is POSTed.
+        """
+        if self.spool is not None and \
+                app.config["EXCEPTIONAL_SPOOL_MODE"] == "all":
+            outcome = self._spool(app, data)
+        elif self.circuit is not None and not self.circuit.allow():
+            outcome = self._spool(app, data)
         else:
-            request_data = None
-            context_data = None
+            try:
+                if response is None:
+                    self._post_error(app, data)
+                else:
+                    self._check(response)
 
-        traceback = traceback or tbtools.get_current_traceback()
-        exception_data = self.__get_exception_data(traceback)
-        encode_basestring = json.encoder.encode_basestring
+                outcome = "sent"
+            except BadStatusLine:
+                outcome = "bad_status"
+            except HTTPError, e:
+                if e.code >= 500 or e.code == 429:
+                    outcome = self._retry(app, data, attempt + 1,
+                            self._get_retry_after(e))
+                else:
+                    outcome = "rejected"
+
+                if self.metrics is not None:
+                    self.metrics.increment("failed")
+
+                message = "Exceptional responded %d %s. %d bytes of error data %s."  # NOQA
+                app.logger.warning(message, e.code, e.msg, len(data),
+                        outcome)
+            except (socket.error, HTTPException):
+                outcome = self._retry(app, data, attempt + 1)
+
+                if self.metrics is not None:
+                    self.metrics.increment("failed")
+
+                message = "Unable to connect to %s. See http://status.exceptional.io for details. %d bytes of error data %s."  # NOQA
+                app.logger.warning(message, self.url, len(data), outcome,
+                        exc_info=True)
+            except Exception:  # never let a delivery error escape.
+                outcome = self._spool(app, data)
 
-        def _encode_basestring(value):
-            if isinstance(value, str) and \
-                    json.encoder.HAS_UTF8.search(value) is not None:
-                value = value.decode("utf-8",
-                        "replace")  # ensure the decode succeeds.
+                if self.metrics is not None:
+                    self.metrics.increment("failed")
 
-            replace = lambda match: json.encoder.ESCAPE_DCT[match.group(0)]
+                message = "Unable to deliver to %s. %d bytes of error data %s."  # NOQA
+                app.logger.error(message, self.url, len(data), outcome,
+                        exc_info=True)
 
-            return u'"%s"' % json.encoder.ESCAPE.sub(replace, value)
+        if self.metrics is not None:
+            self.metrics.increment(outcome)
 
-        try:
-            json.encoder.encode_basestring = _encode_basestring
-            ret_val = json.dumps({
-                "application_environment": application_data,
-                "client": client_data,
-                "request": request_data,
-                "exception": exception_data,
-                "context": context_data
-            }, ensure_ascii=False).encode("utf-8")
-        finally:
-            json.encoder.encode_basestring = encode_basestring
+    def _retry(self, app, data, attempt, retry_after=None):
+        """Retry sending encoded error data after a transient failure, or
+        spool it once its retries are exhausted. Returns the outcome.
 
-        if context and app.testing:
-            g.exceptional = ret_val
+        :param app: The application the error data belongs to.
+        :param data: The JSON encoded error data.
+        :param attempt: The retry number.
+        :param retry_after: Default ``None``. The number of seconds the API
+                            asked to wait.
+        """
+        if self.retrier is not None and \
+                self.retrier.schedule((app, data), attempt, retry_after):
+            ret_val = "retried"
+        else:
+            ret_val = self._spool(app, data)
 
-        if self.url:
-            request = Request(self.url)
-            request.add_header("Content-Type", "application/json")
+        return ret_val
 
-            if app.debug:
-                data = ret_val
-            else:
-                request.add_header("Content-Encoding", "deflate")
-                data = compress(ret_val, 1)
+    def _spool(self, app, data):
+        """Write encoded error data to the spool, if one is configured.
+        Returns the outcome. Error data that cannot be spooled, e.g. because
+        the disk is full, is dropped; spool errors are logged, never raised.
 
+        :param app: The application the error data belongs to.
+        :param data: The JSON encoded error data.
+        """
+        if self.spool is None:
+            ret_val = "dropped"
+        else:
             try:
-                try:
-                    urlopen(request, data)
-                except HTTPError, e:
-                    if e.code >= 400:
-                        raise
-            except URLError:
-                message = "Unable to connect to %s. See http://status.exceptional.io for details. Error data:\n%s"  # NOQA
-                app.logger.warning(message, self.url, ret_val,
+                self.spool.append(*self._compress(app, data))
+                ret_val = "spooled"
+            except (EnvironmentError, ZlibError):
+                ret_val = "dropped"
+                message = "Unable to spool error data to %s. %d bytes of error data dropped."  # NOQA
+                app.logger.error(message, self.spool.directory, len(data),
                         exc_info=True)
-            except BadStatusLine:
-                pass
+
+        return ret_val
+
+    def _spool_retries(self):
+        """Spool error data still waiting to be retried, e.g. on interpreter
+        shutdown. Queued background deliveries are flushed first, since they
+        may fail and be scheduled for retry.
+        """
+        if self.worker is not None:
+            self.worker.flush()
+
+        for app, data in self.retrier.drain():
+            outcome = self._spool(app, data)
+
+            if self.metrics is not None:
+                self.metrics.increment(outcome)
+
+    @staticmethod
+    def _get_retry_after(error):
+        """Get the number of seconds to wait before retrying from the
+        ``Retry-After`` header of the given error response, or ``None``.
+
+        :param error: The :class:`urllib2.HTTPError` response.
+        """
+        value = error.hdrs.get("Retry-After") if error.hdrs else None
+
+        if value is None:
+            ret_val = None
+        elif value.strip().isdigit():
+            ret_val = int(value)
+        else:
+            date = parsedate_tz(value)
+            ret_val = mktime_tz(date) - time() if date else None
 
         return ret_val
 
+    @staticmethod
+    def _compress(app, data):
+        """Compress the given error data. Returns the compressed data and the
+        index of its content encoding in :data:`ENCODINGS`.
+
+        :param app: The application the error data belongs to.
+        :param data: The JSON encoded error data.
+        """
+        encoding = app.config["EXCEPTIONAL_COMPRESSION"]
+        level = app.config["EXCEPTIONAL_COMPRESSION_LEVEL"]
+
+        if app.debug or not encoding or \
+                len(data) < app.config["EXCEPTIONAL_COMPRESSION_THRESHOLD"]:
+            ret_val = data, 0
+        elif encoding == "deflate":
+            ret_val = compress(data, level), 1
+        else:
+            compressor = compressobj(level, DEFLATED, 16 + MAX_WBITS)
+            ret_val = compressor.compress(data) + compressor.flush(), 2
+
+        return ret_val
+
+    @staticmethod
+    def _fingerprint(traceback, endpoint=None, depth=3):
+        """Get a fingerprint identifying repeated occurrences of an error.
+        The fingerprint is built from the exception class, the innermost
+        stack frames and the request endpoint.
+
+        :param traceback: The exception stack trace.
+        :param endpoint: Default ``None``. The request endpoint.
+        :param depth: Default 3. The number of innermost frames to include.
+        """
+        frames = traceback.frames[-depth:] if depth else []
+        key = [traceback.exception_type, endpoint or ""]
+
+        for frame in frames:
+            key.append("%s:%d:%s" % (frame.filename, frame.lineno,
+                frame.function_name))
+
+        key = "\n".join(key)
+
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+
+        return sha1(key).hexdigest()
+
     @staticmethod
     def __filter(app, data, filter_name):
         """Filter sensitive data.
@@ -319,15 +3033,7 @@ class Exceptional(object):
         filter = app.config.get(filter_name)
 
         if filter:
-            ret_val = {}
-
-            for key, value in data.iteritems():
-                for item in filter:
-                    if match(item, key):
-                        value = "[FILTERED]"
-                        break
-
-                ret_val[key] = value
+            ret_val = Filter.get(filter).apply(data)
         else:
             ret_val = dict(data)
 
@@ -347,6 +3053,8 @@ class Exceptional(object):
             value = os.environ[name]
             environment["os.%s" % name] = str(value)
 
+        pkg_resources = _get_pkg_resources()
+
         if pkg_resources:
             modules = {}
 
@@ -366,51 +3074,160 @@ class Exceptional(object):
         }
 
     @staticmethod
-    def __get_exception_data(traceback):
-        """Get exception data.
+    def __get_exception_data(traceback, timestamp, max_frames=None,
+            max_message_bytes=None):
+        """Get exception data. Backtraces longer than ``max_frames`` keep the
+        outermost and innermost frames, with a marker in place of the elided
+        frames.
         """
-        timestamp = datetime.utcnow()
+        frames = traceback.frames
+
+        if max_frames and len(frames) > max_frames:
+            tail = (max_frames + 1) // 2
+            head = max_frames - tail
+            elided = len(frames) - max_frames
+            frames = frames[:head] + [None] + frames[-tail:]
+        else:
+            elided = 0
+
         backtrace = []
 
-        for frame in traceback.frames:
-            backtrace.insert(0, "File \"%s\", line %d, in %s\n\t%s" % (
-                frame.filename,
-                frame.lineno,
-                frame.function_name,
-                frame.current_line.strip()
-            ))
+        for frame in reversed(frames):
+            if frame is None:
+                backtrace.append("... %d frames elided ..." % elided)
+            else:
+                backtrace.append("File \"%s\", line %d, in %s\n\t%s" % (
+                    frame.filename,
+                    frame.lineno,
+                    frame.function_name,
+                    frame.current_line.strip()
+                ))
+
+        message = traceback.exception.split(': ', 1)[-1]
+
+        if max_message_bytes:
+            message = Exceptional.__truncate(message, max_message_bytes)
 
         return {
             "occurred_at": "%sZ" % timestamp.isoformat(),
-            "message": traceback.exception.split(': ', 1)[-1],
+            "message": message,
             "backtrace": backtrace,
             "exception_class": traceback.exception_type
         }
 
     @staticmethod
-    def __get_request_data(app, request, session):
-        """Get request data.
+    def __truncate(value, max_bytes):
+        """Truncate the given string to a maximum number of UTF-8 encoded
+        bytes, marking truncated strings with ``'[TRUNCATED]'``.
         """
-        try:
-            parameters = request.json or {}
-        except:
-            parameters = {"INVALID_JSON": request.data}
+        encoded = value.encode("utf-8") if isinstance(value, unicode) \
+            else value
 
-        form = request.form.to_dict(flat=False)
+        if len(encoded) > max_bytes:
+            ret_val = encoded[:max_bytes]
 
-        for key, value in form.iteritems():
-            if len(value) == 1:
-                parameters[key] = value[0]
-            else:
-                parameters[key] = value
+            if isinstance(value, unicode):
+                ret_val = ret_val.decode("utf-8", "ignore")
 
-        files = request.files.to_dict(flat=False)
+            ret_val += " [TRUNCATED]"
+        else:
+            ret_val = value
 
-        for key, value in files.iteritems():
-            if len(value) == 1:
-                parameters[key] = value[0].filename
-            else:
-                parameters[key] = [file.filename for file in value]
+        return ret_val
+
+    @staticmethod
+    def __limit(parameters, max_parameters, max_value_bytes):
+        """Limit the number of parameters and the size of parameter values.
+        """
+        if max_parameters and isinstance(parameters, dict) and \
+                len(parameters) > max_parameters:
+            keys = sorted(parameters)[:max_parameters]
+            dropped = len(parameters) - max_parameters
+            parameters = dict((key, parameters[key]) for key in keys)
+        else:
+            dropped = 0
+
+        if max_value_bytes:
+            ret_val = Exceptional.__limit_value(parameters, max_value_bytes)
+        else:
+            ret_val = parameters
+
+        if dropped:
+            ret_val["TRUNCATED_PARAMETERS"] = "%d parameters" % dropped
+
+        return ret_val
+
+    @staticmethod
+    def __limit_value(value, max_bytes):
+        """Truncate all strings within the given value.
+        """
+        if isinstance(value, basestring):
+            ret_val = Exceptional.__truncate(value, max_bytes)
+        elif isinstance(value, dict):
+            ret_val = dict((key, Exceptional.__limit_value(item, max_bytes))
+                for key, item in value.iteritems())
+        elif isinstance(value, (list, tuple)):
+            ret_val = [Exceptional.__limit_value(item, max_bytes)
+                for item in value]
+        else:
+            ret_val = value
+
+        return ret_val
+
+    @staticmethod
+    def __get_parameters(app, request):
+        """Get request parameters. The request body is only read if it is no
+        larger than ``EXCEPTIONAL_MAX_BODY_BYTES``, or if the application
+        already read it.
+        """
+        max_body_bytes = app.config["EXCEPTIONAL_MAX_BODY_BYTES"]
+        length = request.content_length
+
+        if length is None and "chunked" in request.headers.get(
+                "Transfer-Encoding", "").lower():
+            readable = False
+        else:
+            readable = not max_body_bytes or (length or 0) <= max_body_bytes
+
+        if readable or hasattr(request, "_cached_json") or \
+                hasattr(request, "_cached_data"):
+            try:
+                parameters = request.json or {}
+            except:
+                parameters = {"INVALID_JSON": request.data}
+
+            if isinstance(parameters, dict):
+                parameters = dict(parameters)  # don't modify the cached JSON.
+        else:
+            parameters = {"TRUNCATED_BODY": "%s bytes" % (length or
+                "unknown")}
+
+        if readable or "form" in request.__dict__:
+            form = request.form.to_dict(flat=False)
+
+            for key, value in form.iteritems():
+                if len(value) == 1:
+                    parameters[key] = value[0]
+                else:
+                    parameters[key] = value
+
+            files = request.files.to_dict(flat=False)
+
+            for key, value in files.iteritems():
+                if len(value) == 1:
+                    parameters[key] = value[0].filename
+                else:
+                    parameters[key] = [file.filename for file in value]
+
+        return parameters
+
+    @staticmethod
+    def __get_request_data(app, request, report):
+        """Get request data.
+        """
+        parameters = Exceptional.__limit(report.parameters,
+                app.config["EXCEPTIONAL_MAX_PARAMETERS"],
+                app.config["EXCEPTIONAL_MAX_VALUE_BYTES"])
 
         if request.cookies:
             cookies = Exceptional.__filter(app, request.cookies,
@@ -426,17 +3243,315 @@ class Exceptional(object):
             headers = request.headers
 
         return {
-            "session": Exceptional.__filter(app, session,
+            "session": Exceptional.__filter(app, report.session,
                 "EXCEPTIONAL_SESSION_FILTER"),
             "remote_ip": request.remote_addr,
             "parameters": Exceptional.__filter(app, parameters,
                 "EXCEPTIONAL_PARAMETER_FILTER"),
-            "action": request.endpoint.split('.', 1)[-1] if request.endpoint
+            "action": report.endpoint.split('.', 1)[-1] if report.endpoint
                 else None,
             "url": request.url,
             "request_method": request.method,
-            "controller": request.blueprint if hasattr(request, "blueprint")
-                else request.module,
+            "controller": report.controller,
             "headers": Exceptional.__filter(app, headers,
                 "EXCEPTIONAL_HEADER_FILTER")
         }
+
+
+class Publisher(object):
+    """Long-lived publisher for tracking errors that occur outside the
+    context of a Flask request, e.g. from Celery tasks. The application and
+    extension are created once from the given configuration, so the URL,
+    compiled filters and encoded application environment are reused by
+    every publish. A publisher may be shared across threads, and recreates
+    its extension in processes forked after it was created.
+
+    :param config: A Flask application configuration object. Accepts either
+                   :class:`flask.Config` or the object types allowed by
+                   :meth:`flask.Config.from_object`.
+    """
+
+    def __init__(self, config):
+        """Create this publisher.
+        """
+        self.config = Publisher.load(config)
+        self.lock = Lock()
+        self.pid = None
+        self._create()
+
+    @staticmethod
+    def get(config):
+        """Get the shared publisher for the given configuration. Publishers
+        are shared by configurations with the same ``EXCEPTIONAL_*``,
+        ``DEBUG`` and ``TESTING`` settings; the shared publisher is updated
+        with the other configuration values, e.g. for its application
+        environment data.
+
+        :param config: The configuration to get a publisher for.
+        """
+        config = Publisher.load(config)
+        key = tuple(sorted((name, _freeze(value))
+            for name, value in config.iteritems()
+            if name.startswith("EXCEPTIONAL_") or
+            name in ("DEBUG", "TESTING")))
+
+        with _publishers_lock:
+            ret_val = _publishers.get(key)
+
+            if ret_val is None:
+                ret_val = _publishers[key] = Publisher(config)
+            elif ret_val.config != config:
+                ret_val.update(config)
+
+        return ret_val
+
+    @staticmethod
+    def load(config):
+        """Load the given configuration into a new :class:`flask.Config`.
+
+        :param config: The configuration to load.
+        """
+        ret_val = Config(None)
+
+        if isinstance(config, Config):
+            ret_val.update(config)
+        else:
+            ret_val.from_object(config)
+
+        return ret_val
+
+    @property
+    def exceptional(self):
+        """Get the :class:`Exceptional` extension for the current process.
+        """
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self._create()
+
+        return self._exceptional
+
+    def publish(self, traceback=None):
+        """Publish the given traceback to Exceptional. Returns the published
+        error data.
+
+        :param traceback: Default ``None``. A :class:`Backtrace` or
+                          :class:`werkzeug.debug.tbtools.Traceback` instance
+                          to publish. The current exception is captured by
+                          default.
+        """
+        return self.exceptional._publish(self.app, traceback)
+
+    def publish_async(self, traceback=None, callback=None):
+        """Publish the given traceback to Exceptional without blocking the
+        calling thread. Returns a :class:`Submission` whose result is the
+        published error data.
+
+        :param traceback: Default ``None``. A :class:`Backtrace` or
+                          :class:`werkzeug.debug.tbtools.Traceback` instance
+                          to publish. The current exception is captured by
+                          default.
+        :param callback: Default ``None``. A callable invoked with the
+                         :class:`Submission` once it completes.
+        """
+        traceback = traceback or Backtrace.capture()
+        exceptional = self.exceptional
+
+        return exceptional.dispatcher.submit(exceptional._publish,
+                (self.app, traceback), callback)
+
+    def update(self, config):
+        """Update the configuration of this publisher. Changes to the
+        ``EXCEPTIONAL_*`` settings take effect in a new publisher only.
+
+        :param config: The configuration to update from.
+        """
+        with self.lock:
+            self.config = Publisher.load(config)
+            self.app.config.update(self.config)
+
+    def _create(self):
+        """Create the application and extension for this process.
+        """
+        app = Flask(__name__)
+        app.config.update(self.config)
+        self._exceptional = Exceptional(app)
+        self.app = app
+        self.pid = os.getpid()
+
+
+class Agent(object):
+    """Local agent that delivers error data on behalf of every process on a
+    host, e.g. the workers of a prefork server. Processes configured with
+    ``EXCEPTIONAL_AGENT_SOCKET`` hand their encoded error data to the agent
+    over a Unix domain socket, so deduplication, rate limits, batching,
+    compression and delivery apply host-wide and use a single connection
+    pool. Run the agent in a sidecar or master process::
+
+        Agent(app.config).serve_forever()
+
+    :param config: A Flask application configuration object. Accepts either
+                   :class:`flask.Config` or the object types allowed by
+                   :meth:`flask.Config.from_object`.
+    :param path: Default ``None``. The socket path to listen on, otherwise
+                 ``EXCEPTIONAL_AGENT_SOCKET`` is used.
+    """
+
+    def __init__(self, config, path=None):
+        """Create this agent.
+        """
+        config = Publisher.load(config)
+        self.path = path or config["EXCEPTIONAL_AGENT_SOCKET"]
+        config["EXCEPTIONAL_AGENT_SOCKET"] = None
+        config["EXCEPTIONAL_BACKGROUND"] = True
+        self.publisher = Publisher(config)
+        self.received = 0
+        self.dropped = 0
+        self.listener = None
+
+    def receive(self, fingerprint, data):
+        """Receive the given error data for delivery. Returns ``False`` if the
+        error data was suppressed or dropped.
+
+        :param fingerprint: The error fingerprint, or ``None``.
+        :param data: The JSON encoded error data.
+        """
+        app = self.publisher.app
+        exceptional = self.publisher.exceptional
+        self.received += 1
+
+        if exceptional.deduplicator is not None and fingerprint:
+            occurrences = exceptional.deduplicator.check(fingerprint)
+        else:
+            occurrences = 1
+
+        if occurrences is None or (exceptional.limiter is not None and
+                not exceptional.limiter.allow(fingerprint)):
+            ret_val = False
+        else:
+            if occurrences > 1:
+                error = json.loads(data)
+                exception = error["exception"]
+                exception["occurrences"] = exception.get("occurrences", 1) + \
+                    occurrences - 1
+                data = _encoder.encode(error)
+
+            report = Report(exceptional, app, None, fingerprint=fingerprint,
+                    data=data)
+
+            if exceptional.deduplicator is not None and fingerprint:
+                exceptional.deduplicator.attach(fingerprint, report)
+
+            if exceptional.worker is not None:
+                ret_val = exceptional.worker.put(report)
+            elif exceptional.url:
+                exceptional._deliver(report)
+                ret_val = True
+            else:
+                ret_val = False
+
+        if not ret_val:
+            self.dropped += 1
+
+        return ret_val
+
+    def serve_forever(self):
+        """Listen for and receive error data until :meth:`stop` is called.
+        """
+        if self.listener is None:
+            self._listen()
+
+        listener = self.listener
+
+        while True:
+            try:
+                connection = listener.accept()[0]
+            except socket.error:
+                break  # the agent was stopped.
+
+            thread = Thread(target=self._handle, args=(connection,),
+                    name="flask-exceptional-agent")
+            thread.daemon = True
+            thread.start()
+
+    def start(self):
+        """Listen for and receive error data on a background thread.
+        """
+        self._listen()
+        thread = Thread(target=self.serve_forever,
+                name="flask-exceptional-agent")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self, timeout=None):
+        """Stop listening, and wait for received error data to be delivered.
+        Returns ``True`` if the queued error data was delivered before the
+        timeout expired.
+
+        :param timeout: Default ``None``. The number of seconds to wait for
+                        delivery, otherwise ``EXCEPTIONAL_QUEUE_FLUSH_TIMEOUT``
+                        is used.
+        """
+        listener, self.listener = self.listener, None
+
+        if listener is not None:
+            try:
+                listener.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+            listener.close()
+
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+        worker = self.publisher.exceptional.worker
+
+        return worker.flush(timeout) if worker else True
+
+    def _handle(self, connection):
+        """Receive error data frames from the given connection until it is
+        closed.
+        """
+        stream = connection.makefile("rb")
+        logger = self.publisher.app.logger
+
+        try:
+            while True:
+                header = stream.read(8)
+
+                if len(header) < 8:
+                    break
+
+                fingerprint_length, data_length = unpack_from(">II", header)
+                fingerprint = stream.read(fingerprint_length)
+                data = stream.read(data_length)
+
+                if len(data) < data_length:
+                    break
+
+                try:
+                    self.receive(fingerprint or None, data)
+                except Exception:  # never let bad data kill the connection.
+                    logger.exception("Exceptional agent delivery failed.")
+        except socket.error:
+            pass
+        finally:
+            stream.close()
+            connection.close()
+
+    def _listen(self):
+        """Bind the agent socket, replacing a stale socket file.
+        """
+        try:
+            os.unlink(self.path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.path)
+        listener.listen(128)
+        self.listener = listener
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+    soak
+    ~~~~
+
+    Flask Exceptional extension soak test. Drives an error storm through a
+    Flask application while a local stand-in for the Exceptional API injects
+    faults, and reports request latency, delivery outcomes and memory growth
+    as JSON. For example, to fail every request from 32 threads for a minute
+    while the API hangs::
+
+        $ python soak.py --threads 32 --duration 60 --fault hang --background
+
+    :copyright: (c) 2012 by Jonathan Zempel.
+    :license: BSD, see LICENSE for more details.
+"""
+
+from argparse import ArgumentParser
+from flask import abort, Flask
+from flask_exceptional import ConnectionPool, Exceptional, Retrier
+from random import choice
+from tests import StandInHandler, StandInServer
+from threading import Thread
+from time import sleep, time
+import gc
+import json
+import resource
+
+FAULTS = ("none", "slow", "hang", "error", "mixed")
+
+
+class FaultHandler(StandInHandler):
+    """Request handler for an Exceptional API stand-in that injects faults.
+    The ``slow`` fault delays each response, ``hang`` never responds,
+    ``error`` responds with ``503 Service Unavailable`` and ``mixed`` picks a
+    fault at random for each request.
+    """
+
+    def do_POST(self):
+        """Record the POSTed error data, or inject a fault.
+        """
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        fault = self.server.fault
+
+        if fault == "mixed":
+            fault = choice(FAULTS[:-1])
+
+        if fault == "hang":
+            sleep(self.server.hang)
+            self.close_connection = 1
+
+            return
+        elif fault == "slow":
+            sleep(self.server.delay)
+
+        if fault == "error":
+            self.send_response(503)
+        else:
+            self.server.posts.append(body)
+            self.send_response(200)
+
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+def get_memory():
+    """Get the resident memory of this process in kilobytes.
+    """
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentile(values, percent):
+    """Get the given percentile of the given values.
+    """
+    values = sorted(values)
+
+    if not values:
+        return None
+
+    return values[min(int(len(values) * percent / 100.0), len(values) - 1)]
+
+
+def create_application(server, background, timeout):
+    """Create an application that reports errors to the given server.
+    """
+    ret_val = Flask(__name__)
+    ret_val.config["EXCEPTIONAL_API_KEY"] = "key"
+    ret_val.config["EXCEPTIONAL_BACKGROUND"] = background
+    ret_val.config["EXCEPTIONAL_METRICS"] = True
+    ret_val.config["EXCEPTIONAL_READ_TIMEOUT"] = timeout
+    ret_val.config["PROPAGATE_EXCEPTIONS"] = False
+
+    @ret_val.route("/error")
+    def error():
+        1 / 0
+
+    @ret_val.route("/http/<int:code>")
+    def http(code):
+        abort(code)
+
+    exceptional = Exceptional(ret_val)
+    exceptional.url = server.url
+    exceptional.pool = ConnectionPool.get(server.url,
+        read_timeout=timeout)
+    exceptional.retrier = Retrier(exceptional._send, logger=ret_val.logger)
+
+    return ret_val
+
+
+def soak(duration=10, threads=8, fault="none", background=False,
+        http_fraction=0.5, delay=0.5, timeout=2):
+    """Fail every request to an application from the given number of threads
+    for the given number of seconds. Returns the soak results.
+
+    :param duration: Default 10. The number of seconds to soak for.
+    :param threads: Default 8. The number of concurrent request threads.
+    :param fault: Default ``'none'``. The fault the stand-in injects, one of
+                  :data:`FAULTS`.
+    :param background: Default ``False``. Whether to deliver error data in
+                       the background.
+    :param http_fraction: Default 0.5. The fraction of requests that fail
+                          with an HTTP error rather than an exception.
+    :param delay: Default 0.5. The number of seconds a ``slow`` response is
+                  delayed.
+    :param timeout: Default 2. The delivery read timeout in seconds.
+    """
+    server = StandInServer(FaultHandler)
+    server.fault = fault
+    server.delay = delay
+    server.hang = duration + timeout * 2
+    app = create_application(server, background, timeout)
+    exceptional = app.extensions["exceptional"]
+    latencies = [[] for index in xrange(threads)]
+    escaped = []
+    deadline = time() + duration
+
+    def run(latencies):
+        client = app.test_client()
+        index = 0
+
+        while time() < deadline:
+            index += 1
+
+            if index * http_fraction % 1 < http_fraction:
+                path = "/http/404"
+            else:
+                path = "/error"
+
+            start = time()
+
+            try:
+                client.get(path)
+            except Exception:  # a reporting error escaped into the request.
+                escaped.append(path)
+
+            latencies.append(time() - start)
+
+    gc.collect()
+    memory = get_memory()
+    objects = len(gc.get_objects())
+    workers = [Thread(target=run, args=(latencies[index],))
+        for index in xrange(threads)]
+    start = time()
+
+    for worker in workers:
+        worker.start()
+
+    for worker in workers:
+        worker.join()
+
+    elapsed = time() - start
+    queued = exceptional.worker.queue.qsize() if exceptional.worker else 0
+    gc.collect()
+    latencies = sum(latencies, [])
+    stats = exceptional.stats
+    ret_val = {
+        "fault": fault,
+        "background": background,
+        "threads": threads,
+        "requests": len(latencies),
+        "requests_per_second": len(latencies) / elapsed,
+        "request_latency_p50": percentile(latencies, 50),
+        "request_latency_p99": percentile(latencies, 99),
+        "request_latency_max": max(latencies) if latencies else None,
+        "escaped": len(escaped),
+        "delivered": len(server.posts),
+        "queued_at_end": queued,
+        "counters": exceptional.metrics.counters,
+        "memory_growth_kb": get_memory() - memory,
+        "object_growth": len(gc.get_objects()) - objects
+    }
+
+    if stats is not None:
+        ret_val["worker_batches"] = stats.batches
+        ret_val["worker_latency_mean"] = stats.mean_latency
+        ret_val["worker_latency_max"] = stats.max_latency
+        ret_val["worker_dropped"] = exceptional.worker.dropped
+
+    server.stop()
+
+    return ret_val
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Soak test Flask-Exceptional.")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--fault", choices=FAULTS, default="none")
+    parser.add_argument("--background", action="store_true")
+    parser.add_argument("--http-fraction", type=float, default=0.5)
+    parser.add_argument("--delay", type=float, default=0.5)
+    parser.add_argument("--timeout", type=float, default=2)
+    arguments = parser.parse_args()
+    print json.dumps(soak(**vars(arguments)), indent=2, sort_keys=True)